@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import asyncio
+import datetime
+import importlib
+
+
+def load_app(module='app'):
+    sys.path.insert(0, '.')
+    return importlib.import_module(module).app
+
+
+def precompile(module='app'):
+    names = asyncio.run(load_app(module).precompile_templates())
+    print(f'{len(names)} templates compiled.')
+
+
+def compile_translations(folder='lang'):
+    from .catalog import compile_catalog
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.toml'):
+            lang = name.removesuffix('.toml')
+            count = compile_catalog(f'{folder}/{name}', f'{folder}/{lang}.catalog')
+            print(f'{lang}: {count} texts.')
+
+
+def benchmark_json(rows='10000', rounds='20'):
+    from fastapi.responses import JSONResponse
+    from fastapi.encoders import jsonable_encoder
+    from .language import Translation
+    from .responses import FastJSONResponse, orjson
+    now = datetime.datetime.now()
+    data = {'rows': [
+        {'id': i, 'name': Translation(f'Name {i}'), 'price': i * 1.5, 'active': i % 2 == 0,
+         'created_on': now, 'modified_on': now}
+        for i in range(int(rows))
+    ]}
+
+    def measure(name, fn):
+        start = time.perf_counter()
+        for _ in range(int(rounds)):
+            fn()
+        elapsed = (time.perf_counter() - start) / int(rounds)
+        print(f'{name:<40}{elapsed * 1000:10.2f} ms')
+
+    # JSONResponse can't serialize datetimes by itself; this is what FastAPI does for it.
+    measure('JSONResponse + jsonable_encoder', lambda: JSONResponse(jsonable_encoder(data)))
+    measure(f"FastJSONResponse ({'orjson' if orjson else 'json'})", lambda: FastJSONResponse(data))
+
+
+commands = {
+    'precompile': precompile,
+    'compile-translations': compile_translations,
+    'benchmark-json': benchmark_json,
+}
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in commands:
+        print(f"Usage: python -m callithrix {{{'|'.join(commands)}}} [arguments]")
+        return 1
+    commands[argv[1]](*argv[2:])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,5 +1,6 @@
 import os
 import json
+import asyncio
 import string
 import random
 import inspect
@@ -7,16 +8,24 @@ import pathlib
 import functools
 import importlib
 from domain import model
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
-from .jinja import SmartTemplates
+from .jinja import SmartTemplates, build_reverse_urls, compiled_fields
+from .form import schema_cache, form_templates
 from .authapp import AuthApp
 from .db import DBApp
 from .language import LangApp
+from .mail import MailApp
+from .jobs import JobApp
+from .fragments import FragmentCache
+from .pagecache import PageCache
+from .responses import FastJSONResponse
 
 
-class SmartApp(DBApp, AuthApp, LangApp):
+class SmartApp(DBApp, AuthApp, LangApp, MailApp, JobApp):
+    json_response = FastJSONResponse
+
     def __init__(self, *args, static_path="static", templates_path="templates", config_folder="config/", **kwargs):
         self.base_template = str(pathlib.Path(__file__).parent.resolve())+'/templates'
         if not isinstance(templates_path, list):
@@ -24,11 +33,27 @@ class SmartApp(DBApp, AuthApp, LangApp):
         self.templates_path = templates_path
         self.config = self.load_config(config_folder)
         self.globals = {}
+        kwargs.setdefault('default_response_class', self.json_response)
         DBApp.__init__(self, *args, **kwargs)
+        AuthApp.__init__(self)
         self.mount("/static", StaticFiles(directory=static_path), name="static")
         self.templates = None
+        self.fragment_cache = FragmentCache(**self.config.get('fragment_cache', {}))
+        self.repository.on_change(self.fragment_cache.invalidate)
+        self.page_cache = PageCache(**self.config.get('page_cache', {}))
+        self.html_paths = []
+        self.template_map = {}
+        self.startup_hooks.append(self.build_template_map)
+        self.startup_hooks.append(self.build_reverse_urls)
+        if self.config.get('precompile_templates', True):
+            self.startup_hooks.append(self.precompile_templates)
+        if self.config.get('watch_templates'):
+            self.startup_hooks.append(self.watch_templates)
         self.add_middleware(SessionMiddleware, secret_key=self.config['secret_key'])
         LangApp.__init__(self, *args, **kwargs)
+        self.on_translations_change(self.translations_changed)
+        MailApp.__init__(self)
+        JobApp.__init__(self)
 
 
     def load_config(self, config_folder="config/"):
@@ -57,11 +82,20 @@ class SmartApp(DBApp, AuthApp, LangApp):
     def patchhtml(self, path, *args, **kwargs):
         return self.req_html(self.patch, path, *args, **kwargs)
 
-    def req_html(self, method, path, *args, tags=('html',), **kwargs):
+    def req_html(self, method, path, *args, tags=('html',), stream=False, cache=0, **kwargs):
+        self.html_paths.append(path)
         def decorator(fn):
             @method(path, *args, tags=tags, **kwargs)
             @functools.wraps(fn)
             async def wrapper(*args, **kwargs):
+                request = kwargs.get('request')
+                if cache and request is not None and self.page_cache.cacheable(request):
+                    key = self.page_cache.key(request, self.getT(request).language)
+                    render = functools.partial(respond, *args, streaming=False, **kwargs)
+                    return await self.page_cache.fetch(key, request, render, cache)
+                return await respond(*args, streaming=stream, **kwargs)
+
+            async def respond(*args, streaming=False, **kwargs):
                 nonlocal path
                 ret_val = fn(*args, **kwargs)
                 if inspect.iscoroutine(ret_val):
@@ -70,50 +104,129 @@ class SmartApp(DBApp, AuthApp, LangApp):
                     request = kwargs.get('request')
                     if request is None:
                         raise ValueError("Your function's first argument should be 'request: Request'")
-                    template_val= {
-                        "form": await request.form(),
-                        "request": request,
-                        "globals": self.globals,
-                        "roles": [],
-                        "permissions": [],
-                        "user": {},
-                    }
-                    userid = request.session.get('userid')
-                    if userid:
-                        template_val['roles'] = await self.get_roles(userid)
-                        template_val['permissions'] = await self.get_permissions(userid)
-                        template_val['user'] = await self.repository.get('User', userid)
-                    template_val.update(ret_val)
                     if request.query_params.get('format') != 'json':
                         if 'template_path' in dir(request):
                             path = request.template_path
-                        ret = self.render_template(path, template_val)
-                        if ret:
-                            return ret
-                    return JSONResponse(ret_val)
+                        template = self.template_for(path)
+                        if template:
+                            template_val = await self.template_context(request, template)
+                            template_val.update(ret_val)
+                            return self.render_template(path, template_val, stream=streaming)
+                    return self.json_response(ret_val)
                 if isinstance(ret_val, str):
                     return HTMLResponse(ret_val)
                 return ret_val
             return wrapper
         return decorator
 
-    def render_template(self, path, return_value):
+    async def template_context(self, request, template):
+        """Build the default context, skipping the entries the template never reads."""
+        names = self.get_templates().context_names(template)
+        template_val = {
+            "form": {},
+            "request": request,
+            "globals": self.globals,
+            "roles": [],
+            "permissions": [],
+            "user": {},
+        }
+        if names is None or 'form' in names:
+            template_val['form'] = await request.form()
+        userid = request.session.get('userid')
+        if userid and (names is None or not names.isdisjoint(('roles', 'permissions', 'user'))):
+            principal = await self.load_principal(userid)
+            template_val['roles'] = principal['roles']
+            template_val['permissions'] = principal['permissions']
+            template_val['user'] = principal['user'] or {}
+        return template_val
+
+    def render_template(self, path, return_value, stream=False):
+        template = self.template_for(path)
+        if not template:
+            return None
         if 'title' not in return_value:
             return_value['title'] = ''
-        templates_path = self.templates_path + [self.base_template]
+        templates = self.get_templates()
+        request = return_value['request']
+        language = self.getT(request).language
+        if stream:
+            return templates.StreamingTemplateResponse(template, return_value, language=language)
+        return templates.TemplateResponse(request=request, name=templates.get_template(template, language),
+                                          context=return_value)
+
+    def get_templates(self):
         if not self.templates:
-            self.templates = SmartTemplates(directory=templates_path)
+            self.templates = SmartTemplates(directory=self.templates_path + [self.base_template],
+                                            cache_dir=self.config.get('template_cache', 'cache/templates/'),
+                                            fragment_cache=self.fragment_cache,
+                                            translate=self.translate,
+                                            translation_version=self.translation_version,
+                                            translated_languages=self.languages)
+        return self.templates
+
+    async def precompile_templates(self):
+        return self.get_templates().precompile(self.languages())
+
+    def find_template(self, path):
         path = path.replace('{', '_').replace('}', '')
         if not path.endswith('/'):
             path += '/'
-        for basepath in templates_path:
+        for basepath in self.templates_path + [self.base_template]:
             if os.path.isfile(f"{basepath}{path[:-1]}.html"):
-                return self.templates.TemplateResponse(f"{path[:-1]}.html", return_value)
+                return f"{path[:-1]}.html"
             if os.path.isfile(f"{basepath}{path}index.html"):
-                return self.templates.TemplateResponse(f"{path}index.html", return_value)
+                return f"{path}index.html"
+        return None
+
+    def template_for(self, path):
+        # Missing templates are cached too, as None.
+        template = self.template_map.get(path, False)
+        if template is False:
+            template = self.find_template(path)
+            self.template_map = {**self.template_map, path: template}
+        return template
+
+    async def build_template_map(self):
+        self.template_map = {path: self.find_template(path) for path in self.html_paths}
+
+    async def build_reverse_urls(self):
+        build_reverse_urls(self.routes)
+
+    def translations_changed(self, lang):
+        """Drop everything rendered or compiled with the old translations."""
+        if self.templates:
+            self.templates.forget_language(lang)
+        schema_cache.clear()
+        form_templates.clear()
+        compiled_fields.clear()
+        self.fragment_cache.clear()
+        self.page_cache.clear()
+
+    def reload_templates(self):
+        self.template_map = {path: self.find_template(path) for path in self.template_map}
+        self.templates = None
+        self.fragment_cache.clear()
+
+    def templates_signature(self):
+        signature = []
+        for basepath in self.templates_path + [self.base_template]:
+            for root, dirs, files in os.walk(basepath):
+                signature.append((root, os.stat(root).st_mtime_ns))
+        return signature
+
+    async def watch_templates(self, interval=1):
+        async def watch():
+            signature = await asyncio.to_thread(self.templates_signature)
+            while True:
+                await asyncio.sleep(interval)
+                current = await asyncio.to_thread(self.templates_signature)
+                if current != signature:
+                    signature = current
+                    self.reload_templates()
+        self.template_watcher = asyncio.create_task(watch())
 
 
-class SubApp(AuthApp):
+class SubApp(AuthApp, JobApp):
     def __init__(self, module, path=None):
         self.module = module
         if not path:
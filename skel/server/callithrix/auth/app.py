@@ -3,7 +3,6 @@ from callithrix import SubApp
 from callithrix.form import ModelForm, Form
 from callithrix.types import FormField
 from fastapi.responses import RedirectResponse
-from ..utils import email
 from datetime import datetime, timedelta
 import domain
 import string
@@ -43,9 +42,8 @@ async def do_login(request: Request, email: FormField, password: FormField, next
     msg = ("danger", T("E-mail {email} is not a user. Please try again.").format(email=email))
 
     if user:
-        password = app.repository.encode_password(password, user['id'])
         msg = ("danger", T("Invalid password. Please try again."))
-        if password == user['password']:
+        if await app.repository.verify_password(password, user):
             request.session['userid'] = user['id']
             request.session['flash'] = T("You have been logged in. Welcome.")
             return RedirectResponse(next or '/', status_code=302)
@@ -83,13 +81,11 @@ async def post_account(request: Request):
         save_data['validation_code'] = generate_code()
 
     if form.get('password'):
-        current_password = app.repository.encode_password(form['current_password'], user['id'])
-
-        if current_password != user['password']:
+        if not await app.repository.verify_password(form.get('current_password'), user):
             request.session['flash'] = ("danger", T("Invalid password. Please try again."))
             return await account(request=request)
 
-        save_data['password'] = app.repository.encode_password(form['password'], user['id'])
+        save_data['password'] = await app.repository.encode_password(form['password'])
 
     try:
 
@@ -131,7 +127,7 @@ async def post_signup(request: Request):
 
     if user:
 
-        if user['password'] == app.repository.encode_password(form.get('password'), user['id']):
+        if await app.repository.verify_password(form.get('password'), user):
             request.session['userid'] = user['id']
             return RedirectResponse(request.query_params.get('next', '/'), status_code=302)
 
@@ -228,8 +224,7 @@ async def post_forgot_password(request: Request):
         user['recovery_code'] = str(uuid.uuid4())
         async with app.storage.transaction():
             await app.repository.save('User', user)
-        email.init(app.config)
-        email.enviar_email(
+        await app.mailer.send(
             subject=T('Recover your password'),
             to=user['email'],
             message=str('''<p>{greeting}</p>
@@ -283,7 +278,7 @@ async def post_recover_password(request: Request):
         return RedirectResponse(request.url_for('forgot_password'), status_code=302)
 
     user['recovery_code'] = None
-    user['password'] = app.repository.encode_password(form.get('password'), user['id'])
+    user['password'] = await app.repository.encode_password(form.get('password'))
     async with app.storage.transaction():
         await app.repository.save('User', user)
 
@@ -304,8 +299,7 @@ async def populate_first_user(userid):
 
 async def send_validation_code(userid):
     user = await app.repository.get('User', userid)
-    email.init(app.config)
-    email.enviar_email(
+    await app.mailer.send(
         subject='Validate your e-mail',
         to=user['email'],
         message=f"Your validation code is {user['validation_code']}",
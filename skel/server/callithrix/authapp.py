@@ -1,9 +1,43 @@
+import time
 import functools
 from urllib.parse import quote as escape
 from fastapi.responses import RedirectResponse
 
 
+principal_entities = ('userrole', 'role', 'rolepermission', 'permission')
+
+
+class PrincipalCache:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.version = 0
+        self.entries = {}
+
+    def get(self, user_id):
+        entry = self.entries.get(str(user_id))
+        if entry:
+            expires, version, principal = entry
+            if version == self.version and expires > time.monotonic():
+                return principal
+            del self.entries[str(user_id)]
+
+    def set(self, user_id, principal, version):
+        if version == self.version:
+            self.entries[str(user_id)] = (time.monotonic() + self.ttl, version, principal)
+
+    def invalidate(self, entity, entity_id):
+        if entity in principal_entities:
+            self.version += 1
+            self.entries.clear()
+        elif entity == 'user':
+            self.entries.pop(str(entity_id), None)
+
+
 class AuthApp:
+    def __init__(self):
+        self.principals = PrincipalCache(self.config.get('principal_ttl', 60))
+        self.repository.on_change(self.principals.invalidate)
+
     def requires(self, *permissions):
 
         def decorator(fn):
@@ -14,12 +48,16 @@ class AuthApp:
                 if not request.session.get('userid'):
                     return self.auth_redirect('login', request)
 
-                user = await self.repository.get('User', request.session['userid'])
+                principal = await self.load_principal(request.session['userid'])
+                user = principal['user']
+
+                if not user:
+                    return self.auth_redirect('login', request)
 
                 if user.get('validation_code'):
                     return self.auth_redirect('validate_email', request)
 
-                if not await self.has_permission(request, *permissions):
+                if permissions and not set(permissions) & set(principal['permissions']):
                     request.session['flash'] = ('danger', 'You do not have permission to access this page')
                     return RedirectResponse('/')
 
@@ -30,32 +68,55 @@ class AuthApp:
         return decorator
 
 
-    async def get_roles(self, user_id):
-        roles = await self.storage.execute(f'''
+    @functools.cached_property
+    def principal_sql(self):
+        return f'''
             SELECT
-                role.name
+                user.*,
+                role.name AS principal_role,
+                permission.name AS principal_permission
             FROM
-                role, userrole
+                user
+                LEFT JOIN userrole ON userrole.user_id = user.id
+                LEFT JOIN role ON role.id = userrole.role_id
+                LEFT JOIN rolepermission ON rolepermission.role_id = role.id
+                LEFT JOIN permission ON permission.id = rolepermission.permission_id
             WHERE
-                userrole.user_id = {user_id}
-                AND userrole.role_id = role.id
-        ''', ())
-        return [role['name'] for role in roles]
+                user.id = {self.storage.placeholder(1)}
+        '''
+
+
+    async def load_principal(self, user_id):
+        principal = self.principals.get(user_id)
+        if principal:
+            return principal
+
+        version = self.principals.version
+        rows = [dict(row) for row in await self.storage.execute(self.principal_sql, (user_id,))]
+        roles = []
+        permissions = []
+        for row in rows:
+            role = row.pop('principal_role')
+            permission = row.pop('principal_permission')
+            if role and role not in roles:
+                roles.append(role)
+            if permission and permission not in permissions:
+                permissions.append(permission)
+        principal = {
+            'user': rows[0] if rows else None,
+            'roles': roles,
+            'permissions': permissions,
+        }
+        self.principals.set(user_id, principal, version)
+        return principal
+
+
+    async def get_roles(self, user_id):
+        return (await self.load_principal(user_id))['roles']
 
 
     async def get_permissions(self, user_id):
-        permissions = await self.storage.execute(f'''
-            SELECT
-                permission.name
-            FROM
-                permission, rolepermission, role, userrole
-            WHERE
-                userrole.user_id = {user_id}
-                AND userrole.role_id = role.id
-                AND role.id = rolepermission.role_id
-                AND rolepermission.permission_id = permission.id
-        ''', ())
-        return [permission['name'] for permission in permissions]
+        return (await self.load_principal(user_id))['permissions']
 
 
     async def has_permission(self, request, *permissions):
@@ -65,19 +126,8 @@ class AuthApp:
         if not request.session.get('userid'):
             return False
 
-        return bool(await self.storage.execute(f'''
-            SELECT
-                user.id
-            FROM
-                user, userrole, role, rolepermission, permission
-            WHERE
-                user.id = {request.session['userid']}
-                AND userrole.user_id = user.id
-                AND userrole.role_id = role.id
-                AND role.id = rolepermission.role_id
-                AND rolepermission.permission_id = permission.id
-                AND permission.name IN ('{"','".join(permissions)}')
-        ''', ()))
+        principal = await self.load_principal(request.session['userid'])
+        return bool(set(permissions) & set(principal['permissions']))
 
 
     def auth_redirect(self, fn_name, request):
@@ -86,4 +136,3 @@ class AuthApp:
         if query_params:
             redir_url += escape(f"?{query_params}")
         return RedirectResponse(redir_url)
-
@@ -0,0 +1,103 @@
+"""Compiled translation catalogs.
+
+A catalog is an open addressing hash table of utf-8 strings, read straight
+from a memory map, so loading one doesn't depend on its size and all server
+processes share the same pages.
+
+Layout: header (magic, count, table size, version), table of (key offset,
+key length, value offset, value length) slots, then the strings.
+"""
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+import toml
+
+MAGIC = b'CLX2'
+HEADER = struct.Struct('<4sII20s')
+SLOT = struct.Struct('<IIII')
+
+
+def version(data):
+    """Digest of the texts that are actually translated.
+
+    Texts that translate to themselves (like the ones saved when missing) don't
+    change it, since they render the same with or without an entry.
+    """
+    digest = hashlib.sha1()
+    for key, value in sorted(data.items()):
+        if key != value:
+            digest.update(f'{key}\0{value}\0'.encode())
+    return digest.digest()
+
+
+def compile_catalog(source, target):
+    with open(source) as f:
+        data = {str(key): str(value) for key, value in toml.load(f).items()}
+    size = 8
+    while size < len(data) * 2:
+        size *= 2
+    slots = [None] * size
+    strings = bytearray()
+    base = HEADER.size + SLOT.size * size
+    for key, value in data.items():
+        key, value = key.encode(), value.encode()
+        key_offset = base + len(strings)
+        strings += key
+        value_offset = base + len(strings)
+        strings += value
+        index = zlib.crc32(key) & (size - 1)
+        while slots[index]:
+            index = (index + 1) & (size - 1)
+        slots[index] = (key_offset, len(key), value_offset, len(value))
+    temp = f'{target}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(data), size, version(data)))
+        for slot in slots:
+            f.write(SLOT.pack(*(slot or (0, 0, 0, 0))))
+        f.write(strings)
+    # Processes that have the old catalog mapped keep reading it until they swap.
+    os.replace(temp, target)
+    return len(data)
+
+
+class Catalog:
+    """Read only mapping over a compiled catalog. Texts set at runtime are kept apart."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.size, version = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a translation catalog')
+        self.version = version.hex()
+        self.extra = {}
+
+    def lookup(self, text):
+        key = text.encode()
+        index = zlib.crc32(key) & (self.size - 1)
+        while True:
+            key_offset, key_length, value_offset, value_length = SLOT.unpack_from(
+                self.map, HEADER.size + SLOT.size * index)
+            if not key_offset:
+                return None
+            if key_length == len(key) and self.map[key_offset:key_offset + key_length] == key:
+                value = self.map[value_offset:value_offset + value_length].decode()
+                self.extra[text] = value
+                return value
+            index = (index + 1) & (self.size - 1)
+
+    def __contains__(self, text):
+        return text in self.extra or self.lookup(text) is not None
+
+    def __getitem__(self, text):
+        if text in self.extra:
+            return self.extra[text]
+        value = self.lookup(text)
+        if value is None:
+            raise KeyError(text)
+        return value
+
+    def __setitem__(self, text, value):
+        self.extra[text] = value
@@ -3,36 +3,36 @@ import jinja2
 import functools
 from callithrix.optimage.app import app as imageserver
 from fastapi import Request
+from markupsafe import escape
 from callithrix import jinja
 from callithrix.form import ModelForm
+from callithrix.repository.storage.migrations import get_label_field
 from fastapi.responses import RedirectResponse
+from callithrix.responses import FastJSONResponse
 
 
 hidden_headers = ['created_at', 'updated_at', 'created_by', 'updated_by', 'password', 'validation_code']
 
 
-@jinja2.pass_context
-def db_table(context, table, rows, headers=None, readonly=False, T=lambda t:t, labels={}, max_cols=6, prefix='admin_'):
-    request = context['request']
-    if rows:
-        if not headers:
-            headers = [h for h in rows[0].keys() if h not in hidden_headers][:max_cols]
-        tbody = ''
-        for row in rows:
-            tbody += '<tr>'
-            for header in headers:
-                tbody += f'<td><a href="{request.url_for(prefix+"edit", table=table, id=row["id"])}">{row[header]}</a></td>'
-            tbody += '<td>'
-            if (table!='user' or row['id']!=request.session.get('userid')) and not readonly:
-                tbody += f'''
+ID = '__id__'
+
+
+def table_chunks(request, table, rows, headers=None, readonly=False, T=lambda t:t, labels={}, max_cols=6,
+                 prefix='admin_', chunk_size=200):
+    if not rows:
+        return
+    if not headers:
+        headers = [h for h in rows[0].keys() if h not in hidden_headers][:max_cols]
+    # Routes are resolved once; each row only formats its id into them.
+    edit_url = str(request.url_for(prefix+"edit", table=table, id=ID)).split(ID)
+    delete_button = f'''
                     <a
-                        href="{request.url_for(prefix+"delete", table=table, id=row["id"])}"
+                        href="{request.url_for(prefix+"delete", table=table, id=ID)}"
                         @click.prevent="if(confirm('{T('Are you sure you want to delete this record?')}')) location.href=$event.target.href"
                         class="button is-danger is-small">{T('Delete')}</a>
-                '''
-            tbody += '</td>'
-            tbody += '</tr>'
-        table = f'''
+                '''.split(ID)
+    own_id = request.session.get('userid') if table == 'user' else None
+    yield f'''
             <div class="table-container">
             <table class="table is-fullwidth is-striped is-hoverable" x-data="{'{}'}">
                 <thead>
@@ -42,20 +42,48 @@ def db_table(context, table, rows, headers=None, readonly=False, T=lambda t:t, l
                     </tr>
                 </thead>
                 <tbody>
-                    {tbody}
+        '''
+    chunk = []
+    for row in rows:
+        id = str(row['id'])
+        edit = id.join(edit_url)
+        chunk.append('<tr>')
+        chunk.extend([f'<td><a href="{edit}">{escape(row[header])}</a></td>' for header in headers])
+        chunk.append('<td>')
+        if row['id'] != own_id and not readonly:
+            chunk.append(id.join(delete_button))
+        chunk.append('</td></tr>')
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append('''
                 </tbody>
             </table>
             </div>
-        '''
-    return jinja.Markup(table)
+        ''')
+    yield ''.join(chunk)
+
+
+@jinja2.pass_context
+def db_table(context, table, rows, headers=None, readonly=False, T=lambda t:t, labels={}, max_cols=6, prefix='admin_'):
+    return jinja.Markup(''.join(table_chunks(context['request'], table, rows, headers, readonly, T, labels,
+                                             max_cols, prefix)))
+
+
+@jinja2.pass_context
+def db_table_chunks(context, table, rows, headers=None, readonly=False, T=lambda t:t, labels={}, max_cols=6,
+                    prefix='admin_'):
+    for chunk in table_chunks(context['request'], table, rows, headers, readonly, T, labels, max_cols, prefix):
+        yield jinja.Markup(chunk)
 
 
 jinja.env_globals['db_table'] = db_table
+jinja.env_globals['db_table_chunks'] = db_table_chunks
 
 
 class Crud:
     def __init__(self, app, domain, name, path='/', tables=None, permissions=(),
-                 filters={}, readonly=(), admin=False, defaults={}, form_templates={}):
+                 filters={}, readonly=(), admin=False, defaults={}, form_templates={}, lookup_limit=20):
         self.tables = tables
         self.permissions = permissions
         self.path = path.removesuffix('/')
@@ -68,11 +96,13 @@ class Crud:
         self.admin = admin
         self.defaults = defaults
         self.form_templates = form_templates
+        self.lookup_limit = lookup_limit
 
         self.plug(self.home, '/')
         self.plug(self.table, '/{table}')
         self.plug(self.new, '/{table}/new')
         self.plug(self.post_new, '/{table}/new', 'post', write=True)
+        self.plug(self.lookup, '/{table}/lookup')
         self.plug(self.edit, '/{table}/{id}')
         self.plug(self.post_edit, '/{table}/{id}', 'post', write=True)
         self.plug(self.delete, '/{table}/delete/{id}', write=True)
@@ -118,16 +148,48 @@ class Crud:
         rows = await self.app.repository.find(table, filters.get(table, {}))
         return [(row['id'], str(entity(**row))) for row in rows]
 
-    async def get_relations(self, request, table):
+    async def select_label(self, request, table, id):
+        if not id:
+            return ''
+        entity = get_model(self.domain, table)
+        filters = dict(self.build_filters(request).get(table, {}))
+        filters['id'] = id
+        row = await self.app.repository.find_one(table, filters)
+        return str(entity(**row)) if row else ''
+
+    async def get_relations(self, request, table, values={}):
         relations = {}
         entity = get_model(self.domain, table)
         for field in entity.model_fields:
             if field.endswith('_id'):
-                field = field.removesuffix('_id')
-                if (not self.tables or field in self.tables) and get_model(self.domain, field):
-                    relations[field] = await self.select_options(request, field)
+                name = field.removesuffix('_id')
+                if (not self.tables or name in self.tables) and get_model(self.domain, name):
+                    relations[name] = {
+                        'url': str(request.url_for(self.prefix+'lookup', table=name)),
+                        'selected': await self.select_label(request, name, values.get(field)),
+                    }
         return relations
 
+    async def lookup(self, request: Request, table: str, q: str = '', limit: int = 0):
+        entity = get_model(self.domain, table)
+        if not entity:
+            return FastJSONResponse({'detail': 'Not Found'}, status_code=404)
+        filters = dict(self.build_filters(request).get(table, {}))
+        label = get_label_field(entity)
+        limit = min(limit or self.lookup_limit, self.lookup_limit)
+        q = q.strip()
+        if label:
+            if q:
+                filters[label] = ('istartswith', q)
+            # Same expression as the lower(label) index, so it also serves the order and LIMIT.
+            order_by = {f'lower({label})': 'ASC'}
+        else:
+            if q:
+                filters['id'] = int(q) if q.isdigit() else 0
+            order_by = {'id': 'ASC'}
+        rows = await self.app.repository.find(table, filters, limit=limit, order_by=order_by)
+        return FastJSONResponse([{'id': row['id'], 'label': str(entity(**row))} for row in rows])
+
     async def home(self, request: Request):
         if self.tables and len(self.tables) == 1:
             return RedirectResponse(request.url_for(self.prefix+'table', table=self.tables[0]), status_code=302)
@@ -138,7 +200,7 @@ class Crud:
         T = self.app.getT(request)
         filters = self.build_filters(request)
         rows = await self.app.repository.find(table, filters.get(table, {}))
-        rows = [await self.prepare_row(row) for row in rows]
+        rows = await self.prepare_rows(rows)
         entity = get_model(self.domain, table)
         labels = {}
         for name, field in entity.model_fields.items():
@@ -149,23 +211,35 @@ class Crud:
         return {'title': T(f'List of {table}'), 'rows': rows, 'table': table, 'labels': labels, 'total_tables': len(self.tables or [])}
 
     async def prepare_row(self, row):
-        prepared = {}
-        for k, v in row.items():
-            if k in hidden_headers:
-                continue
-            if k.endswith('_id'):
-                m = get_model(self.domain, k.removesuffix('_id'))
-                if m:
+        return (await self.prepare_rows([row]))[0]
+
+    async def prepare_rows(self, rows, batch_size=500):
+        # One query per relation (per batch of ids) instead of one per row and relation.
+        relations = {}
+        for k in (rows[0].keys() if rows else []):
+            m = k.endswith('_id') and k not in hidden_headers and get_model(self.domain, k.removesuffix('_id'))
+            if m:
+                ids = list({row[k] for row in rows if row[k] is not None})
+                relations[k] = {}
+                for i in range(0, len(ids), batch_size):
+                    objs = await self.app.repository.find(k.removesuffix('_id'), {'id': ('in', ids[i:i+batch_size])})
+                    relations[k].update({obj['id']: str(m(**obj)) for obj in objs})
+        prepared = []
+        for row in rows:
+            prepared_row = {}
+            for k, v in row.items():
+                if k in hidden_headers:
+                    continue
+                if k in relations:
+                    v = relations[k].get(v, v)
                     k = k.removesuffix('_id')
-                    obj = await self.app.repository.get(k, v)
-                    if obj:
-                        v = str(m(**obj))
-            prepared[k] = v
+                prepared_row[k] = v
+            prepared.append(prepared_row)
         return prepared
 
     async def new(self, request: Request, table: str):
         T = self.app.getT(request)
-        relations = await self.get_relations(request, table)
+        relations = await self.get_relations(request, table, await request.form())
         the_form = ModelForm(get_model(self.domain, table), action=T('Save'), admin=self.admin, relations=relations,
                              readonly=(table in self.readonly), T=T, template=self.form_templates.get(table))
         rows = await self.app.repository.find(table)
@@ -181,10 +255,10 @@ class Crud:
 
     async def edit(self, request: Request, table: str, id: int):
         T = self.app.getT(request)
-        relations = await self.get_relations(request, table)
+        obj = await self.app.repository.get(table, id)
+        relations = await self.get_relations(request, table, {**obj, **await request.form()})
         the_form = ModelForm(get_model(self.domain, table), action=T('Save'), admin=self.admin, relations=relations,
                              readonly=(table in self.readonly), T=T, template=self.form_templates.get(table))
-        obj = await self.app.repository.get(table, id)
         the_form.load(obj)
         tables = await self.app.repository.get_tables()
         return {'title': T('Admin page'), 'tables': tables, 'table': table, 'the_form': the_form}
@@ -223,8 +297,10 @@ def get_model(domain, table):
 async def save_obj(request, table, app, domain, defaults={}):
     obj = {}
     obj.update(defaults.get(table, {}))
+    model = get_model(domain, table)
     form = dict(**await request.form())
     form_items = list(form.items())
+    images = []
     for k, v in form_items:
         if k.startswith('imgfile_'):
             del form[k]
@@ -233,23 +309,28 @@ async def save_obj(request, table, app, domain, defaults={}):
                 filename = f'{time.time()}-{table}_{fieldname}.{v.filename.split(".")[-1]}'
                 await imageserver.save_image(v, filename)
                 form[fieldname] = filename
+                images.append((fieldname, filename))
 
     obj.update(form)
 
     if 'id' in obj and not obj['id']:
         del obj['id']
 
-    model = get_model(domain, table)
     model(**obj)
 
     if 'password' in obj:
         if obj['password']:
-            obj['password'] = app.repository.encode_password(obj['password'])
+            obj['password'] = await app.repository.encode_password(obj['password'])
         else:
             del obj['password']
 
     async with app.storage.transaction():
         saved = await app.repository.save(table, obj)
 
+    for fieldname, filename in images:
+        field = model.model_fields.get(fieldname)
+        extra = field and field.json_schema_extra or {}
+        await imageserver.generate_derivatives(filename, extra.get('sizes', ()))
+
     return saved
 
@@ -1,5 +1,6 @@
 from fastapi import FastAPI
 from .repository import repo
+from .repository.hashers import PasswordHasher
 from .repository.storage.sql import Storage
 
 
@@ -10,16 +11,24 @@ class DBApp(FastAPI):
         async def lifespan(_):
             await self.storage.init()
             await self.storage.migrate(self.model)
+            for hook in self.startup_hooks:
+                await hook()
             yield
+            for hook in reversed(self.shutdown_hooks):
+                await hook()
             await self.storage.backend.close()
+            self.repository.hasher.close()
 
         self.model = model
+        self.startup_hooks = []
+        self.shutdown_hooks = []
         kwargs['lifespan'] = lifespan
         super().__init__(*args, **kwargs)
         self.init_repository()
 
     def init_repository(self):
         self.storage = Storage(self.config['dbconn'])
-        self.repository = repo.Repository(self.storage, secret_key=self.config['secret_key'])
+        hasher = PasswordHasher.from_config(self.config.get('password_hasher', {}), self.config['secret_key'])
+        self.repository = repo.Repository(self.storage, secret_key=self.config['secret_key'], hasher=hasher)
 
 
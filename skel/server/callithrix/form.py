@@ -1,7 +1,33 @@
-import re
+import os
+import jinja2
 from .jinja import post_field
 from pydantic import EmailStr, SecretStr
 
+
+# (path, environment) -> (mtime, compiled template)
+form_templates = {}
+default_environment = jinja2.Environment(autoescape=True)
+
+
+def sync_environment(environment):
+    """Forms render synchronously, even inside a streamed (async) page."""
+    while environment and environment.is_async:
+        environment = getattr(environment, 'sync_environment', None) or environment.linked_to
+    return environment or default_environment
+
+
+def form_template(path, environment=None):
+    environment = sync_environment(environment)
+    mtime = os.stat(path).st_mtime_ns
+    cached = form_templates.get((path, environment))
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path) as f:
+        template = environment.from_string(f.read())
+    form_templates[(path, environment)] = (mtime, template)
+    return template
+
+
 class Form(dict):
     def __init__(self, *fields, action="Save", method="POST", admin=False, relations=None,
                  readonly=False, T=lambda t:t, template=None, _class="box", extra_buttons=()):
@@ -26,13 +52,8 @@ class Form(dict):
         html = f'''
             <form method="{self.method}" {'enctype="multipart/form-data" ' if self.method.lower()=='post' else ''}class="{self._class}">'''
         if self.template:
-            with open(self.template) as f:
-                template = f.read()
-            template = re.sub(r'\{\{ *', '__START__', template)
-            template = re.sub(r' *\}\}', '__END__', template)
-            template = template.replace('{', '{{').replace('}', '}}')
-            template = template.replace('__START__', '{').replace('__END__', '}')
-            html += template.format(form_method=self.method, form_readonly=self.readonly, **fields)
+            template = form_template(self.template, getattr(context, 'environment', None))
+            html += template.render(form_method=self.method, form_readonly=self.readonly, **fields)
         else:
             html += ''.join(fields.values())
             if not self.readonly:
@@ -49,15 +70,56 @@ class Form(dict):
         return html
 
 
+# (model, language, admin) -> field dicts. Labels are already translated.
+schema_cache = {}
+
+
+def model_schema(model, admin=False, T=lambda t: t):
+    key = (model, getattr(T, 'language', None), admin)
+    schema = schema_cache.get(key)
+    if schema is None:
+        schema = {}
+        for name, field in model.model_fields.items():
+            if admin or not (field.json_schema_extra and field.json_schema_extra.get('internal')):
+                schema[name] = field_dict(name, field, T)
+        schema_cache[key] = schema
+    return schema
+
+
+def field_dict(name, field, T=lambda t: t):
+    fd = {
+        'name': name,
+        'label': T(field.json_schema_extra and field.json_schema_extra.get('label', '') or name.removesuffix('_id').replace('_', ' ').title()),
+        'required': field.is_required(),
+    }
+    inputtype = field.json_schema_extra and field.json_schema_extra.get('inputtype')
+    if inputtype:
+        fd['type'] = inputtype
+        if inputtype == 'imageupload' and field.json_schema_extra.get('sizes'):
+            # Preview with the first declared size, which is generated on upload.
+            fd['width'], fd['height'] = map(int, field.json_schema_extra['sizes'][0].split('x'))
+    elif field.annotation == EmailStr:
+        fd['type'] = 'email'
+    elif field.annotation == SecretStr:
+        fd['type'] = 'password'
+    elif field.annotation == bool:
+        fd['type'] = 'checkbox'
+    elif name == 'id':
+        fd['type'] = 'hidden'
+    for metadata in field.metadata:
+        if 'max_length' in dir(metadata):
+            fd['maxlength'] = metadata.max_length
+    return fd
+
+
 class ModelForm(Form, dict):
     def __init__(self, model, action="Save", method="POST", admin=False, relations=None, readonly=False,
                  T=lambda t: t, template=None, _class="box", extra_buttons=()):
         self.model = model
         Form.__init__(self, action=action, method=method, admin=admin, relations=relations,
                       readonly=readonly, T=T, template=template, _class=_class)
-        for name, field in model.model_fields.items():
-            if self.admin or not (field.json_schema_extra and field.json_schema_extra.get('internal')):
-                self.fields[name] = self.field_dict(name, field)
+        for name, field in model_schema(model, self.admin, T).items():
+            self.fields[name] = dict(field)
 
     def load(self, data):
         for field in self.fields.values():
@@ -72,24 +134,5 @@ class ModelForm(Form, dict):
                     field['value'] = ''
 
     def field_dict(self, name, field):
-        fd = {
-            'name': name,
-            'label': self.T(field.json_schema_extra and field.json_schema_extra.get('label', '') or name.removesuffix('_id').replace('_', ' ').title()),
-            'required': field.is_required(),
-        }
-        inputtype = field.json_schema_extra and field.json_schema_extra.get('inputtype')
-        if inputtype:
-            fd['type'] = inputtype
-        elif field.annotation == EmailStr:
-            fd['type'] = 'email'
-        elif field.annotation == SecretStr:
-            fd['type'] = 'password'
-        elif field.annotation == bool:
-            fd['type'] = 'checkbox'
-        elif name == 'id':
-            fd['type'] = 'hidden'
-        for metadata in field.metadata:
-            if 'max_length' in dir(metadata):
-                fd['maxlength'] = metadata.max_length
-        return fd
+        return field_dict(name, field, self.T)
 
@@ -0,0 +1,110 @@
+import time
+from collections import OrderedDict
+import jinja2
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """LRU of rendered template fragments, bounded by entries and by total size.
+
+    Fragments can depend on entities; a repository write to one of them drops
+    every fragment that declared it.
+    """
+
+    def __init__(self, max_entries=1000, max_size=16 * 1024 * 1024, ttl=300):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.entries = OrderedDict()
+        self.dependents = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry:
+            expires, value, _ = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                return value
+            self.remove(key)
+
+    def set(self, key, value, ttl=None, depends=()):
+        self.remove(key)
+        if len(value) > self.max_size:
+            return value
+        depends = tuple(entity.lower() for entity in depends)
+        self.entries[key] = (time.monotonic() + (ttl or self.ttl), value, depends)
+        self.size += len(value)
+        for entity in depends:
+            self.dependents.setdefault(entity, set()).add(key)
+        while len(self.entries) > self.max_entries or self.size > self.max_size:
+            self.remove(next(iter(self.entries)))
+        return value
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            _, value, depends = entry
+            self.size -= len(value)
+            for entity in depends:
+                self.dependents.get(entity, set()).discard(key)
+
+    def invalidate(self, entity, entity_id=None):
+        for key in list(self.dependents.pop(entity, ())):
+            self.remove(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.dependents.clear()
+        self.size = 0
+
+
+class CacheExtension(Extension):
+    """{% cache 'menu', ttl=600, depends=['manufacturer'] %}...{% endcache %}
+
+    The key is per template and, unless lang=False, per language, so T() output
+    is cached separately for each one.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = parser.parse_expression()
+        options = {'ttl': nodes.Const(None), 'depends': nodes.List([]), 'lang': nodes.Const(True)}
+        while parser.stream.skip_if('comma'):
+            name = parser.stream.expect('name')
+            if name.value not in options:
+                parser.fail(f"Unknown cache option '{name.value}'", name.lineno)
+            parser.stream.expect('assign')
+            options[name.value] = parser.parse_expression()
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        args = [nodes.Const(parser.name), key, options['ttl'], options['depends'],
+                options['lang'], nodes.ContextReference()]
+        return nodes.CallBlock(self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, template, key, ttl, depends, lang, context, caller):
+        cache = self.environment.fragment_cache
+        key = (template, key, language(context) if lang else '')
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if self.environment.is_async:
+            return self._render_async(cache, key, ttl, depends, caller)
+        return cache.set(key, Markup(caller()), ttl, depends)
+
+    async def _render_async(self, cache, key, ttl, depends, caller):
+        return cache.set(key, Markup(await caller()), ttl, depends)
+
+
+def language(context):
+    getT = context.resolve_or_missing('getT')
+    if getT is jinja2.runtime.missing or 'request' not in context:
+        return ''
+    return context.call(getT).language
@@ -1,15 +1,41 @@
+import os
 import json
 import jinja2
+from jinja2 import meta
+from jinja2.ext import Extension
+from jinja2.lexer import Token
 from fastapi.templating import Jinja2Templates
-from markupsafe import Markup
+from fastapi.responses import StreamingResponse
+from starlette.routing import Route
+from markupsafe import Markup, escape
+from .fragments import CacheExtension
+
+
+# Route name -> url path of the routes without parameters. Built at startup.
+reverse_urls = {}
+
+
+def build_reverse_urls(routes):
+    reverse_urls.clear()
+    for route in routes:
+        if isinstance(route, Route) and not route.param_convertors and route.name not in reverse_urls:
+            reverse_urls[route.name] = route.url_path_for(route.name)
+
+
+def reverse_url(request, path, **params):
+    if not params and path in reverse_urls:
+        return reverse_urls[path].make_absolute_url(request.base_url)
+    return request.url_for(path, **params)
 
 
 @jinja2.pass_context
 def is_current_url(context, path, **params):
     request = context['request']
+    # Matched by path, so the page is current whatever the method (a POST re-rendering the form too).
+    url = reverse_url(request, path, **params)
     scope = {
-        'type': request.url_for(path, **params).scheme,
-        'path': request.url_for(path, **params).path,
+        'type': url.scheme,
+        'path': url.path,
         'method': 'get',
     }
     match = request.scope['route'].matches(scope)
@@ -22,7 +48,7 @@ def nav_item(context, text, path, _class="navbar-item", active_class='is-active'
     request = context['request']
     if is_current_url(context, path, **params):
         _class += f" {active_class}"
-    link = f'<a href="{request.url_for(path, **params)}" class="{_class}">{text}</a>'
+    link = f'<a href="{reverse_url(request, path, **params)}" class="{_class}">{text}</a>'
     return Markup(link)
 
 
@@ -74,6 +100,39 @@ def select_field(name, label, required, placeholder, options, value=None, T=lamb
     return fieldblock(T(label), field, T('Required') if required else '')
 
 
+def autocomplete_field(name, label, required, placeholder, url, selected='', value=None, T=lambda t: t, **kwargs):
+    data = {
+        'url': url,
+        'value': '' if value is None else str(value),
+        'query': str(selected or ''),
+        'options': [],
+        'open': 0,
+    }
+    data = json.dumps(data).replace("'", "&#x27;")
+    field = f'''
+        <div class="dropdown" x-bind:class="open && options.length ? 'dropdown is-active' : 'dropdown'"
+            x-data='{data}' @click.outside="open=0">
+            <input type="hidden" name="{name}" x-model="value">
+            <div class="dropdown-trigger">
+                <input
+                    class="input" type="text" autocomplete="off" {required and 'required' or ''}
+                    placeholder="{T(placeholder)}" x-model="query"
+                    @focus="open=1"
+                    @input.debounce.250ms="value='';open=1;fetch(url+'?q='+encodeURIComponent(query)).then(r=>r.json()).then(r=>options=r)">
+            </div>
+            <div class="dropdown-menu">
+                <div class="dropdown-content">
+                    <template x-for="option in options" :key="option.id">
+                        <a href="#" class="dropdown-item" x-text="option.label"
+                            @click.prevent="value=option.id;query=option.label;open=0"></a>
+                    </template>
+                </div>
+            </div>
+        </div>
+    '''
+    return fieldblock(T(label), field, T('Required') if required else '')
+
+
 def checkbox_field(name, label, required, placeholder, value, T=lambda t: t, **kwargs):
     field = f'''
         <label class="checkbox" x-data="{'{value: '+('1' if value else '0')+'}'}">
@@ -100,9 +159,25 @@ def textarea_field(name, label, required, placeholder, value, T=lambda t: t, **k
     return fieldblock(T(label), field, T('Required') if required else '', params=params)
 
 
+def srcset_urls(img, width, height, widths=None):
+    widths = widths or [width, width * 2]
+    return ', '.join(f"/optimage/{w}x{round(height * w / width)}/{img} {w}w" for w in widths)
+
+
+def srcset(img, width, height, widths=None, sizes=None):
+    """src, srcset and sizes attributes for an image displayed at width x height (CSS pixels).
+
+    Browsers pick the smallest of widths that is enough for the screen density.
+    """
+    img = escape(img)
+    return Markup(f'src="/optimage/{width}x{height}/{img}" srcset="{srcset_urls(img, width, height, widths)}" '
+                  f'sizes="{escape(sizes or f"{width}px")}"')
+
+
 def imageupload_field(name, label, required, placeholder, value, T, width=240, height=160, **kwargs):
     data = {
         'url': f"/optimage/{width}x{height}/{value}" if value else '',
+        'srcset': srcset_urls(value, width, height) if value else '',
         'hover': 0,
         'file': '',
         'clear': 0,
@@ -115,7 +190,8 @@ def imageupload_field(name, label, required, placeholder, value, T, width=240, h
             </template>
             <div class="column is-narrow">
                 <div x-show="url" @mouseover="hover=1" @mouseout="hover=0" style="position:relative">
-                    <img x-bind:src="url" style="width:{width}px;height:{height}px;object-fit:cover">
+                    <img x-bind:src="url" x-bind:srcset="srcset" sizes="{width}px"
+                        style="width:{width}px;height:{height}px;object-fit:cover">
                     <a href="#" class="button is-danger is-small" x-show="hover"
                         style="position:absolute; bottom:10px; right:10px; z-index:1;"
                         @click.prevent="if(confirm('{T('Remove image?')}')){{url='';document.querySelector('#imgfile_{name}').value='';clear=1}}">{T('Remove')}</a>
@@ -127,7 +203,7 @@ def imageupload_field(name, label, required, placeholder, value, T, width=240, h
             <div class="column">
                 <p>{T('Upload a new image')}</p>
                 <input type="file" name="imgfile_{name}" id="imgfile_{name}" class="input"
-                    @change="if($event.target.files[0])url=URL.createObjectURL($event.target.files[0])"
+                    @change="if($event.target.files[0]){{url=URL.createObjectURL($event.target.files[0]);srcset=''}}"
                     {'required' if (required and not value) else ''}>
             </div>
         </div>
@@ -175,7 +251,7 @@ def form_field(context, name, label=None, placeholder=None, type='text', require
     if placeholder is None:
         placeholder = label
     if name.endswith('_id') and name.removesuffix('_id') in relations:
-        type = 'select'
+        type = 'autocomplete' if isinstance(relations[name.removesuffix('_id')], dict) else 'select'
     if type == 'password':
         field = password_field(name, label, required, placeholder, T, **kwargs)
     elif type == 'change-password':
@@ -186,6 +262,8 @@ def form_field(context, name, label=None, placeholder=None, type='text', require
         '''
     elif type == 'select':
         field = select_field(name, label, required, placeholder, value=value, options=relations[name.removesuffix('_id')], T=T, **kwargs)
+    elif type == 'autocomplete':
+        field = autocomplete_field(name, label, required, placeholder, value=value, T=T, **relations[name.removesuffix('_id')], **kwargs)
     elif type == 'checkbox':
         field = checkbox_field(name, label, required, placeholder, value, T, **kwargs)
     elif type == 'textarea':
@@ -197,11 +275,47 @@ def form_field(context, name, label=None, placeholder=None, type='text', require
     return Markup(field)
 
 
+# Markup of fields that only depend on their value, keyed by everything else.
+compiled_fields = {}
+VALUE = '\x00value\x00'
+
+
+def compile_field(name, label, placeholder, type, required, admin, T, kwargs):
+    if type == 'checkbox':
+        checked = str(form_field({}, name, label, placeholder, type, required, 1, admin, {}, T, **kwargs))
+        unchecked = str(form_field({}, name, label, placeholder, type, required, 0, admin, {}, T, **kwargs))
+        return lambda value: checked if value else unchecked
+    parts = str(form_field({}, name, label, placeholder, type, required, VALUE, admin, {}, T, **kwargs)).split(VALUE)
+    return lambda value: str(escape(value)).join(parts)
+
+
+def compiled_field(name, label, placeholder, type, required, admin, relations, T, kwargs):
+    if name.endswith('_id') and relations and name.removesuffix('_id') in relations:
+        return None
+    if type in ('select', 'autocomplete', 'textarea', 'imageupload'):
+        return None
+    try:
+        key = (name, label, placeholder, type, required, admin, getattr(T, 'language', None),
+               tuple(sorted(kwargs.items())))
+        render = compiled_fields.get(key)
+    except TypeError:
+        return None
+    if render is None:
+        render = compile_field(name, label, placeholder, type, required, admin, T, kwargs)
+        if len(compiled_fields) > 10000:
+            compiled_fields.clear()
+        compiled_fields[key] = render
+    return render
+
+
 @jinja2.pass_context
 def post_field(context, name, label=None, placeholder=None, type='text', required=False, admin=False, relations=None, T=lambda t: t, **kwargs):
     value = context['form'].get(name, kwargs.get('value', ''))
     if 'value' in kwargs:
         del kwargs['value']
+    render = compiled_field(name, label, placeholder, type, required, admin, relations, T, kwargs)
+    if render:
+        return Markup(render(value))
     return form_field(context, name, label, placeholder, type, required, value, admin, relations, T, **kwargs)
 
 
@@ -214,13 +328,15 @@ def post_form(context, form):
 def flash(context):
     request = context['request']
     color = 'info'
-    flash = request.session.get('flash')
+    if 'flash_message' in context:
+        flash = context['flash_message']
+    else:
+        flash = request.session.pop('flash', None)
 
     if isinstance(flash, tuple) or isinstance(flash, list) :
         color, flash = flash
 
     if flash:
-        del request.session['flash']
         return Markup(f'''
         <div class="container" x-data="{'{ show: true }'}" x-show="show" x-init="setTimeout(()=>show=false,5000)">
             <div class="notification is-{color}">
@@ -239,10 +355,186 @@ env_globals = {
     'post_field': post_field,
     'post_form': post_form,
     'flash': flash,
+    'srcset': srcset,
+}
+
+
+# Context entries read by globals, which template analysis can't see.
+context_dependencies = {
+    'post_field': {'form'},
+    'post_form': {'form'},
 }
 
 
+class TranslationExtension(Extension):
+    """Replaces T('literal') with its translation while compiling.
+
+    Only active in the per language environments, which have translate set.
+    """
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(translate=None)
+
+    def filter_stream(self, stream):
+        translate = self.environment.translate
+        if not translate:
+            yield from stream
+            return
+        tokens = list(stream)
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if (token.type == 'name' and token.value == 'T'
+                    and (i == 0 or tokens[i - 1].type != 'dot')
+                    and [t.type for t in tokens[i + 1:i + 4]] == ['lparen', 'string', 'rparen']):
+                yield Token(token.lineno, 'string', str(translate(tokens[i + 2].value)))
+                i += 4
+                continue
+            yield token
+            i += 1
+
+
+def make_dir(path):
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class LocalizedBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """Bytecode of translated templates, keyed by the version of the translations too."""
+
+    def __init__(self, directory, version):
+        super().__init__(directory)
+        self.version = version
+
+    def get_cache_key(self, name, filename=None):
+        return f'{super().get_cache_key(name, filename)}_{self.version()}'
+
+
 class SmartTemplates(Jinja2Templates):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, directory, cache_dir=None, fragment_cache=None, translate=None, translation_version=None,
+                 translated_languages=None, **env_options):
+        env_options.setdefault('autoescape', True)
+        env_options['extensions'] = [*env_options.get('extensions', []), CacheExtension, TranslationExtension]
+        if cache_dir:
+            # Compiled templates are stored by name and validated by the source checksum,
+            # so they survive restarts and are shared by all workers.
+            env_options['bytecode_cache'] = jinja2.FileSystemBytecodeCache(make_dir(cache_dir))
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(directory), **env_options)
+        super().__init__(env=env)
         self.env.globals.update(env_globals)
+        self.context_names_cache = {}
+        if fragment_cache:
+            self.env.fragment_cache = fragment_cache
+        # Streaming templates are compiled in async mode, so their bytecode is kept apart.
+        async_cache = cache_dir and jinja2.FileSystemBytecodeCache(make_dir(f"{cache_dir.removesuffix('/')}/async"))
+        self.async_env = self.env.overlay(enable_async=True, bytecode_cache=async_cache)
+        self.async_env.sync_environment = self.env
+        self.cache_dir = cache_dir and cache_dir.removesuffix('/')
+        self.translate = translate
+        self.translation_version = translation_version
+        self.translated_languages = translated_languages
+        self.translated = None
+        self.languages = {}
+
+    def localized(self, language, is_async=False):
+        """Environment whose templates have their literal T() calls translated to language.
+
+        The compiled code depends on the translations, so its bytecode is kept
+        per language and version of the translations. Only the languages of the
+        app get one; others (from any Accept-Language) translate at runtime.
+        """
+        if not self.translate or not self.is_translated(language):
+            return self.async_env if is_async else self.env
+        env = self.languages.get((language, is_async))
+        if env is None:
+            cache = None
+            if self.cache_dir and self.translation_version:
+                folder = f"{self.cache_dir}{'/async' if is_async else ''}/lang/{language}"
+                cache = LocalizedBytecodeCache(make_dir(folder), lambda: self.translation_version(language))
+            env = (self.async_env if is_async else self.env).overlay(bytecode_cache=cache)
+            env.translate = lambda text: self.translate(text, language)
+            if is_async:
+                env.sync_environment = self.localized(language)
+            self.languages[(language, is_async)] = env
+        return env
+
+    def is_translated(self, language):
+        if self.translated is None:
+            self.translated = set(self.translated_languages()) if self.translated_languages else set()
+        return language in self.translated
+
+    def forget_language(self, language):
+        self.translated = None
+        self.languages.pop((language, False), None)
+        self.languages.pop((language, True), None)
+
+    def get_template(self, name, language=None):
+        return self.localized(language).get_template(name)
+
+    def StreamingTemplateResponse(self, name, context, status_code=200, headers=None, buffer_size=8192, language=None):
+        request = context['request']
+        # Headers (and the session cookie) are sent before the body renders,
+        # so the flash message is taken out of the session now.
+        context.setdefault('flash_message', request.session.pop('flash', None))
+        template = self.localized(language, is_async=True).get_template(name)
+
+        async def body():
+            buffer = []
+            size = 0
+            async for chunk in template.generate_async(context):
+                buffer.append(chunk)
+                size += len(chunk)
+                if size >= buffer_size or '</head>' in chunk:
+                    yield ''.join(buffer)
+                    buffer = []
+                    size = 0
+            if buffer:
+                yield ''.join(buffer)
+
+        return StreamingResponse(body(), status_code=status_code, headers=headers, media_type='text/html')
+
+    def context_names(self, name):
+        """Names the template, its layouts and includes read from the context.
+
+        None means they can't be known, because some template is chosen at runtime.
+        """
+        entry = self.context_names_cache.get(name)
+        if entry and all(template.is_up_to_date for template in entry[1]):
+            return entry[0]
+        templates = []
+        names = self.find_context_names(name, templates)
+        self.context_names_cache[name] = (names, templates)
+        return names
+
+    def find_context_names(self, name, templates):
+        template = self.env.get_template(name)
+        templates.append(template)
+        source = self.env.loader.get_source(self.env, name)[0]
+        ast = self.env.parse(source, name)
+        names = meta.find_undeclared_variables(ast)
+        for global_name, dependencies in context_dependencies.items():
+            if global_name in names:
+                names |= dependencies
+        for reference in meta.find_referenced_templates(ast):
+            if reference is None:
+                return None
+            if reference in (template.name for template in templates):
+                continue
+            referenced = self.find_context_names(reference, templates)
+            if referenced is None:
+                return None
+            names |= referenced
+        return frozenset(names)
+
+    def precompile(self, languages=()):
+        """Compile the html templates, and their translated versions for each of languages."""
+        names = self.env.list_templates(extensions=['html'])
+        for name in names:
+            self.env.get_template(name)
+        for language in languages:
+            for is_async in (False, True):
+                env = self.localized(language, is_async)
+                for name in names:
+                    env.get_template(name)
+        return names
@@ -0,0 +1,219 @@
+import json
+import time
+import uuid
+import asyncio
+import inspect
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from pydantic import BaseModel, Field
+
+
+class Job(BaseModel):
+    id: Optional[int] = None
+    name: str = Field(max_length=255, index=True)
+    dedupe_key: str = Field(max_length=255, default='', index=True)
+    # The dedupe_key while the job is queued or running, NULL after. Unique, so two
+    # processes can't both enqueue the same key.
+    active_key: str = Field(max_length=255, default=None, unique=True)
+    payload: str = Field(default='{}', force_type='text')
+    priority: int = 0
+    status: str = Field(max_length=16, default='queued', index=True)
+    attempts: int = 0
+    max_attempts: int = 3
+    run_at: float = Field(default=0, index=True)
+    locked_until: float = 0
+    worker: str = Field(max_length=64, default='')
+    error: str = Field(default='', force_type='text')
+    class Config:
+        audit_table = 'user'
+
+
+# name -> (fn, options). Filled by the @app.job() decorator, even before sub-apps are registered.
+registry = {}
+
+
+def register(fn, name=None, process=False, max_attempts=3, timeout=300, priority=0):
+    name = name or f'{fn.__module__}.{fn.__qualname__}'
+    if process and inspect.iscoroutinefunction(fn):
+        raise ValueError(f"Job {name} runs in a process pool, so it can't be a coroutine")
+    registry[name] = (fn, {
+        'process': process,
+        'max_attempts': max_attempts,
+        'timeout': timeout,
+        'priority': priority,
+    })
+    fn.job_name = name
+    return fn
+
+
+class JobQueue:
+    """Jobs persisted in the job table and run by worker coroutines.
+
+    A claimed job stays invisible to other workers for its timeout. If the worker dies, or
+    the job takes longer than that, it becomes visible again and is retried.
+    """
+
+    def __init__(self, app, concurrency=4, processes=0, poll_interval=5, backoff=10, keep_done=False):
+        self.app = app
+        self.concurrency = concurrency
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.keep_done = keep_done
+        self.executor = None
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        self.worker_id = uuid.uuid4().hex
+
+    async def enqueue(self, job, *args, priority=None, delay=0, key='', **kwargs):
+        name = getattr(job, 'job_name', job)
+        if name not in registry:
+            raise ValueError(f"Job {name} is not registered")
+        _, options = registry[name]
+        if key:
+            existing = await self.app.repository.find_one('job', {'active_key': key})
+            if existing:
+                return existing
+        data = {
+            'name': name,
+            'dedupe_key': key,
+            'active_key': key or None,
+            'payload': json.dumps({'args': args, 'kwargs': kwargs}),
+            'priority': options['priority'] if priority is None else priority,
+            'status': 'queued',
+            'attempts': 0,
+            'max_attempts': options['max_attempts'],
+            'run_at': time.time() + delay,
+            'locked_until': 0,
+            'worker': '',
+            'error': '',
+        }
+        try:
+            saved = await self.app.repository.save('job', data)
+        except Exception:
+            # Another process enqueued the same key in between.
+            existing = key and await self.app.repository.find_one('job', {'active_key': key})
+            if existing:
+                return existing
+            raise
+        self.wakeup.set()
+        return saved
+
+    @property
+    def placeholders(self):
+        return [self.app.storage.placeholder(i) for i in range(1, 5)]
+
+    async def claim(self):
+        now = time.time()
+        p = self.placeholders
+        candidates = await self.app.storage.execute(f'''
+            SELECT id, name FROM job
+            WHERE run_at <= {p[0]}
+                AND (status = 'queued' OR (status = 'running' AND locked_until < {p[1]}))
+            ORDER BY priority DESC, run_at ASC
+            LIMIT {self.concurrency}
+        ''', (now, now))
+        for candidate in candidates:
+            name = candidate['name']
+            timeout = registry[name][1]['timeout'] if name in registry else 300
+            token = f'{self.worker_id}-{uuid.uuid4().hex[:8]}'
+            # Only one worker wins the conditional update; the others won't find their token.
+            await self.app.storage.execute(f'''
+                UPDATE job SET status = 'running', worker = {p[0]}, locked_until = {p[1]},
+                    attempts = attempts + 1
+                WHERE id = {p[2]}
+                    AND (status = 'queued' OR (status = 'running' AND locked_until < {p[3]}))
+            ''', (token, now + timeout, candidate['id'], now))
+            job = await self.app.repository.find_one('job', {'id': candidate['id'], 'worker': token})
+            if job:
+                return job
+        return None
+
+    async def run(self, job):
+        fn, options = registry[job['name']]
+        payload = json.loads(job['payload'])
+        if options['process'] and self.processes:
+            if not self.executor:
+                self.executor = ProcessPoolExecutor(max_workers=self.processes)
+            loop = asyncio.get_running_loop()
+            coro = loop.run_in_executor(self.executor, call, fn, payload['args'], payload['kwargs'])
+        elif inspect.iscoroutinefunction(fn):
+            coro = fn(*payload['args'], **payload['kwargs'])
+        else:
+            coro = asyncio.to_thread(fn, *payload['args'], **payload['kwargs'])
+        return await asyncio.wait_for(coro, options['timeout'])
+
+    async def process(self, job):
+        if job['name'] not in registry:
+            await self.fail(job, f"Job {job['name']} is not registered", retry=False)
+            return
+        try:
+            await self.run(job)
+        except Exception:
+            await self.fail(job, traceback.format_exc())
+            return
+        if self.keep_done:
+            await self.app.repository.update('job', job['id'], {'id': job['id'], 'status': 'done', 'error': '',
+                                                                'active_key': None})
+        else:
+            await self.app.repository.delete('job', job['id'])
+
+    async def fail(self, job, error, retry=True):
+        data = {'id': job['id'], 'error': error[-4000:]}
+        if retry and job['attempts'] < job['max_attempts']:
+            data['status'] = 'queued'
+            data['run_at'] = time.time() + self.backoff * 2 ** (job['attempts'] - 1)
+        else:
+            data['status'] = 'failed'
+            data['active_key'] = None
+        await self.app.repository.update('job', job['id'], data)
+
+    async def worker(self):
+        while True:
+            try:
+                job = await self.claim()
+            except Exception:
+                traceback.print_exc()
+                job = None
+            if job:
+                await self.process(job)
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+def call(fn, args, kwargs):
+    return fn(*args, **kwargs)
+
+
+class JobApp:
+    def __init__(self):
+        if 'Job' not in dir(self.model):
+            self.model.Job = Job
+        self.jobs = JobQueue(self, **self.config.get('jobs', {}))
+        self.startup_hooks.append(self.jobs.start)
+        self.shutdown_hooks.append(self.jobs.stop)
+
+    def job(self, name=None, process=False, max_attempts=3, timeout=300, priority=0):
+        def decorator(fn):
+            return register(fn, name, process, max_attempts, timeout, priority)
+        return decorator
+
+    async def enqueue(self, job, *args, **kwargs):
+        return await self.jobs.enqueue(job, *args, **kwargs)
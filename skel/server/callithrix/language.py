@@ -1,6 +1,16 @@
+import os
 import toml
+import asyncio
 import jinja2
+import traceback
 from . import jinja
+from . import catalog
+from .catalog import Catalog
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 class Translator:
@@ -33,6 +43,21 @@ class LangApp:
         self.default = default
         self.langs = langs
         self.data = {}
+        self.versions = {}
+        self.missing = {}
+        self.translation_listeners = []
+        config = self.config.get('translations', {})
+        self.save_missing = config.get('save_missing', True)
+        self.flush_interval = config.get('flush_interval', 5)
+        self.translation_writer = None
+        self.translation_watcher = None
+        self.watch_interval = config.get('watch_interval', 2)
+        if config.get('watch', True):
+            self.startup_hooks.append(self.watch_translations)
+            self.shutdown_hooks.append(self.stop_translation_watcher)
+        if self.save_missing:
+            self.startup_hooks.append(self.start_translation_writer)
+            self.shutdown_hooks.append(self.stop_translation_writer)
 
         @jinja2.pass_context
         def T(context, text):
@@ -58,11 +83,91 @@ class LangApp:
 
     def load_data(self, lang):
         if lang not in self.data:
+            self.data[lang], self.versions[lang] = self.read_translations(lang)
+
+    def read_translations(self, lang):
+        """Load the compiled catalog, unless the toml file was edited after it.
+
+        Return the translations and their version.
+        """
+        try:
+            toml_mtime = os.path.getmtime(f'lang/{lang}.toml')
+        except FileNotFoundError:
+            toml_mtime = 0
+        try:
+            if os.path.getmtime(f'lang/{lang}.catalog') >= toml_mtime:
+                data = Catalog(f'lang/{lang}.catalog')
+                return data, data.version
+        except (FileNotFoundError, ValueError):
+            pass
+        try:
+            with open(f'lang/{lang}.toml') as f:
+                data = toml.load(f)
+        except FileNotFoundError:
+            data = {}
+        return data, catalog.version(data).hex()
+
+    def translation_version(self, lang):
+        self.load_data(lang)
+        return self.versions[lang]
+
+    def languages(self):
+        """The configured languages, or the ones in the lang folder."""
+        if self.langs:
+            return list(self.langs)
+        try:
+            return sorted({name.rsplit('.', 1)[0] for name in os.listdir('lang')
+                           if name.endswith(('.toml', '.catalog')) and not name.startswith('.')})
+        except FileNotFoundError:
+            return []
+
+    def translations_signature(self):
+        try:
+            return {entry.name: entry.stat().st_mtime_ns for entry in os.scandir('lang')
+                    if entry.name.endswith(('.toml', '.catalog'))}
+        except FileNotFoundError:
+            return {}
+
+    async def reload_translations(self, langs=None):
+        for lang in list(self.data):
+            if langs is not None and lang not in langs:
+                continue
+            # Swapping the whole mapping keeps translate() lock free.
+            self.data[lang], version = await asyncio.to_thread(self.read_translations, lang)
+            if version != self.versions.get(lang):
+                self.versions[lang] = version
+                for listener in self.translation_listeners:
+                    listener(lang)
+
+    def on_translations_change(self, listener):
+        """Call listener(lang) after the translations of lang change."""
+        self.translation_listeners.append(listener)
+
+    async def translations_watcher(self):
+        signature = self.translations_signature()
+        while True:
+            await asyncio.sleep(self.watch_interval)
             try:
-                with open(f'lang/{lang}.toml') as f:
-                    self.data[lang] = toml.load(f)
-            except FileNotFoundError:
-                self.data[lang] = {}
+                current = await asyncio.to_thread(self.translations_signature)
+                changed = {name.rsplit('.', 1)[0] for name in signature.keys() | current.keys()
+                           if signature.get(name) != current.get(name)}
+                signature = current
+                if changed:
+                    await self.reload_translations(changed)
+            except Exception:
+                traceback.print_exc()
+
+    async def watch_translations(self):
+        self.translation_watcher = asyncio.create_task(self.translations_watcher())
+
+    async def stop_translation_watcher(self):
+        if self.translation_watcher:
+            self.translation_watcher.cancel()
+            try:
+                await self.translation_watcher
+            except asyncio.CancelledError:
+                pass
+            self.translation_watcher = None
 
     def translate(self, text, lang=None):
         if isinstance(text, Translation):
@@ -70,10 +175,64 @@ class LangApp:
         self.load_data(lang)
         if text not in self.data[lang]:
             self.data[lang][text] = text
-            with open(f'lang/{lang}.toml', 'w') as f:
-                toml.dump(self.data[lang], f)
+            if self.save_missing:
+                self.missing.setdefault(lang, {})[text] = text
         return Translation(self.data[lang][text])
 
+    def write_missing(self, lang, texts):
+        """Add new texts to lang/<lang>.toml, keeping whatever other processes wrote."""
+        path = f'lang/{lang}.toml'
+        compiled = f'lang/{lang}.catalog'
+        with open(f'lang/.{lang}.lock', 'w') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    data = toml.load(f)
+            except FileNotFoundError:
+                data = {}
+            new = {text: value for text, value in texts.items() if text not in data}
+            if not new:
+                return
+            try:
+                current = os.path.getmtime(compiled) >= os.path.getmtime(path)
+            except FileNotFoundError:
+                current = False
+            data.update(new)
+            temp = f'lang/.{lang}.toml.{os.getpid()}.tmp'
+            with open(temp, 'w') as f:
+                toml.dump(data, f)
+            os.replace(temp, path)
+            if current:
+                # New texts translate to themselves, so the catalog is still up to date.
+                os.utime(compiled)
+
+    async def flush_translations(self):
+        missing, self.missing = self.missing, {}
+        for lang, texts in missing.items():
+            await asyncio.to_thread(self.write_missing, lang, texts)
+
+    async def translation_worker(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_translations()
+            except Exception:
+                traceback.print_exc()
+
+    async def start_translation_writer(self):
+        self.translation_writer = asyncio.create_task(self.translation_worker())
+
+    async def stop_translation_writer(self):
+        if self.translation_writer:
+            self.translation_writer.cancel()
+            try:
+                await self.translation_writer
+            except asyncio.CancelledError:
+                pass
+            self.translation_writer = None
+        await self.flush_translations()
+
 
 class Translation(str):
     def __init__(self, text):
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import traceback
+from .utils import email
+
+
+class Mailer:
+    """Outbound mail queue.
+
+    Messages are spooled as JSON files and sent by a background worker that keeps
+    one SMTP session open while there is mail to send.
+    """
+
+    def __init__(self, smtp, spool='mail/', batch_size=20, max_attempts=6, backoff=30,
+                 idle_timeout=60, claim_timeout=600, poll_interval=10):
+        self.smtp = smtp
+        self.spool = spool.removesuffix('/')
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self.connection = email.Connection(smtp)
+        self.wakeup = asyncio.Event()
+        self.task = None
+        for folder in ('queue', 'sending', 'failed'):
+            os.makedirs(f'{self.spool}/{folder}', exist_ok=True)
+
+    async def send(self, subject, to, message, reply_to=None):
+        msg = {
+            'subject': str(subject),
+            'to': to,
+            'message': str(message),
+            'reply_to': reply_to,
+            'attempts': 0,
+            'next_try': 0,
+        }
+        await asyncio.to_thread(self.write, f'{time.time():.6f}-{uuid.uuid4().hex}.json', msg)
+        self.wakeup.set()
+
+    def write(self, name, msg, folder='queue'):
+        temp = f'{self.spool}/{folder}/.{name}.tmp'
+        with open(temp, 'w') as f:
+            json.dump(msg, f)
+        os.replace(temp, f'{self.spool}/{folder}/{name}')
+
+    def claim(self, limit):
+        claimed = []
+        now = time.time()
+        for name in sorted(os.listdir(f'{self.spool}/queue')):
+            if name.startswith('.'):
+                continue
+            try:
+                with open(f'{self.spool}/queue/{name}') as f:
+                    msg = json.load(f)
+                if msg['next_try'] > now:
+                    continue
+                # Renaming is atomic, so only one worker process gets each message.
+                os.rename(f'{self.spool}/queue/{name}', f'{self.spool}/sending/{name}')
+                # The rename keeps the queue time, and recover() goes by the claim time.
+                os.utime(f'{self.spool}/sending/{name}')
+            except (FileNotFoundError, ValueError):
+                continue
+            claimed.append((name, msg))
+            if len(claimed) >= limit:
+                break
+        return claimed
+
+    def recover(self):
+        for name in os.listdir(f'{self.spool}/sending'):
+            path = f'{self.spool}/sending/{name}'
+            try:
+                if os.path.getmtime(path) < time.time() - self.claim_timeout:
+                    os.rename(path, f'{self.spool}/queue/{name}')
+            except FileNotFoundError:
+                pass
+
+    def deliver(self, batch):
+        for name, msg in batch:
+            try:
+                self.connection.send(msg['subject'], msg['to'], msg['message'], msg['reply_to'])
+            except Exception:
+                msg['attempts'] += 1
+                if msg['attempts'] == 1:
+                    email.print_failure(msg['subject'], msg['to'], msg['message'])
+                if msg['attempts'] >= self.max_attempts:
+                    self.write(name, msg, 'failed')
+                else:
+                    msg['next_try'] = time.time() + self.backoff * 2 ** (msg['attempts'] - 1)
+                    self.write(name, msg)
+            try:
+                os.remove(f'{self.spool}/sending/{name}')
+            except FileNotFoundError:
+                pass
+
+    async def worker(self):
+        idle_since = time.monotonic()
+        while True:
+            try:
+                batch = await asyncio.to_thread(self.claim, self.batch_size)
+                if batch:
+                    await asyncio.to_thread(self.deliver, batch)
+                    idle_since = time.monotonic()
+                    continue
+                if self.connection.server and time.monotonic() - idle_since > self.idle_timeout:
+                    await asyncio.to_thread(self.connection.close)
+            except Exception:
+                traceback.print_exc()
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        await asyncio.to_thread(self.recover)
+        self.task = asyncio.create_task(self.worker())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await asyncio.to_thread(self.connection.close)
+
+
+class MailApp:
+    def __init__(self):
+        self.mailer = Mailer(self.config.get('smtp', {}), **self.config.get('mail', {}))
+        self.startup_hooks.append(self.mailer.start)
+        self.shutdown_hooks.append(self.mailer.stop)
@@ -1,15 +1,51 @@
 import os
 import re
 import glob
-import shutil
+import time
 import asyncio
 from fastapi import Request
 from callithrix import SubApp
-from fastapi.responses import FileResponse
-from starlette.background import BackgroundTask
+from . import engine
+from .singleflight import SingleFlight
+from .responses import file_response, IMMUTABLE, TEMPORARY
+from .store import DerivativeStore, parse_size, fit
 
 
 class ImageServerApp(SubApp):
+    image_engine = None
+    store = None
+    buckets = ()
+
+    def register(self, app):
+        super().register(app)
+        config = app.config.get('images', {})
+        self.store = DerivativeStore(
+            [abs_path() + '/original/thumb', abs_path() + '/optimized', abs_path() + '/optimized/thumb'],
+            quota=config.get('quota', 1024 ** 3), max_entries=config.get('max_entries', 100000),
+            rescan_interval=config.get('rescan_interval', 60))
+        self.buckets = [parse_size(size) for size in config.get('buckets', [])]
+        app.startup_hooks.append(self.scan_store)
+        app.shutdown_hooks.append(self.close_engine)
+
+    async def scan_store(self):
+        """Rebuild the store index from disk. The index itself is only changed in the event loop."""
+        started = time.time()
+        self.store.scanning = True
+        try:
+            files = await asyncio.to_thread(self.store.walk)
+        finally:
+            self.store.scanning = False
+        self.store.load(files, started)
+
+    def get_engine(self):
+        if not self.image_engine:
+            self.image_engine = engine.from_config(self.config.get('images', {}))
+        return self.image_engine
+
+    async def close_engine(self):
+        if self.image_engine:
+            self.image_engine.close()
+            self.image_engine = None
 
     async def save_image(self, fileobj, filename):
         if re.match(r'^\d+\.\d+-\w+_\d+_\w+\.\w+$', filename):
@@ -21,24 +57,45 @@ class ImageServerApp(SubApp):
 
         return path
 
+    async def generate_derivatives(self, filename, sizes=()):
+        """Queue the optimized versions of an uploaded image, in every format and size."""
+        for size in [None, *sizes]:
+            width, height = None, None
+            if size:
+                # The same bounds as sizes requested by URL.
+                size = fit(*parse_size(size), self.buckets)
+                if not size:
+                    continue
+                width, height = size
+            for format in formats:
+                if size:
+                    optimized = thumb_paths(filename, width, height)[2]
+                else:
+                    optimized = abs_path() + '/optimized/' + filename
+                optimized = f'{optimized}.{format}'
+                await self.enqueue(derive, filename, width, height, format, key=optimized)
+
     def remove_db_image(self, filename):
         filename = '*.*-' + filename.split('-')[-1]
         original = glob.glob(abs_path() + '/original/' + filename)
-        optimized = glob.glob(abs_path() + '/optimized/' + filename + '.avif')
+        optimized = glob.glob(abs_path() + '/optimized/' + filename + '.*')
         thumbs_original = glob.glob(abs_path() + '/original/thumb/*x*_' + filename)
-        thumbs_optimized = glob.glob(abs_path() + '/optimized/thumb/*x*_' + filename + '.avif')
+        thumbs_optimized = glob.glob(abs_path() + '/optimized/thumb/*x*_' + filename + '.*')
         for thumb in original + optimized + thumbs_original + thumbs_optimized:
             self.remove_file(thumb)
         return path
 
     def remove_file(self, path):
+        self.store.discard(path)
         if os.path.exists(path):
             os.remove(path)
 
 
 app = ImageServerApp(globals())
 path = '/images/'
-tasks = []
+flights = SingleFlight()
+# Preferred first.
+formats = ('avif', 'webp')
 
 
 def init(imagespath=None):
@@ -49,21 +106,54 @@ def init(imagespath=None):
     os.makedirs(abs_path() + '/optimized/thumb', exist_ok=True)
 
 
-async def optimize(original, optimized):
-    if original not in tasks:
-        if not os.path.exists(optimized+'_temp.avif'):
-            tasks.append(original)
-            if original.endswith('.gif'):
-                proc = await asyncio.create_subprocess_shell(
-                    f'ffmpeg -hide_banner -i {original} -c:v libsvtav1 -crf 30 -preset 4 -pix_fmt yuv420p10le -svtav1-params tune=0 -y {optimized}_temp.avif',
-                    stdout=asyncio.subprocess.PIPE)
-            else:
-                proc = await asyncio.create_subprocess_shell(
-                    f'convert {original} -quality 50% {optimized}_temp.avif',
-                    stdout=asyncio.subprocess.PIPE)
-            await proc.communicate()
-            shutil.move(f'{optimized}_temp.avif', optimized)
-            tasks.remove(original)
+async def generate(target, produce):
+    """Run produce() once to create target, and account for it in the store."""
+    async def run():
+        await produce()
+        app.store.add(target)
+        if app.store.needs_scan():
+            await app.scan_store()
+    await flights.run(target, run)
+
+
+@app.job(timeout=600)
+async def optimize(original, optimized, format='avif'):
+    await generate(optimized, lambda: app.get_engine().encode(original, optimized, format))
+
+
+async def resize(original, resized, width, height):
+    await generate(resized, lambda: app.get_engine().resize(original, resized, width, height))
+
+
+@app.job(timeout=600)
+async def derive(img, width=None, height=None, format='avif'):
+    """Produce the optimized image, resized to width x height if given."""
+    if width:
+        original, resized, optimized = thumb_paths(img, width, height)
+        await resize(original, resized, width, height)
+    else:
+        resized = abs_path() + '/original/' + img
+        optimized = abs_path() + '/optimized/' + img
+    await optimize(resized, f'{optimized}.{format}', format)
+
+
+def thumb_paths(img, width, height):
+    return (abs_path() + '/original/' + img,
+            abs_path() + f'/original/thumb/{width}x{height}_{img}',
+            abs_path() + f'/optimized/thumb/{width}x{height}_{img}')
+
+
+def accepted_format(request):
+    """The best of formats the client accepts, or None for the original format."""
+    accepted = set()
+    for item in request.headers.get('accept', '').split(','):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        if 'q=0' not in params:
+            accepted.add(media_type)
+    for format in formats:
+        if f'image/{format}' in accepted:
+            return format
+    return None
 
 def abs_path():
     return path.removeprefix('/').removesuffix('/')
@@ -71,35 +161,44 @@ def abs_path():
 @app.gethtml('/{img}')
 async def server_image(request: Request, img: str):
     original = abs_path() + '/original/' + img
-    optimized = abs_path() + '/optimized/' + img + '.avif'
-    return await serve_image(original, optimized)
-
-
-async def serve_image(original, optimized):
-    if os.path.exists(optimized):
-        return FileResponse(optimized)
-    elif os.path.exists(original):
-        if original in tasks:
-            return FileResponse(original)
-        task = BackgroundTask(optimize, original, optimized)
-        return FileResponse(original, background=task)
+    optimized = abs_path() + '/optimized/' + img
+    return await serve_image(request, original, optimized)
+
+
+async def serve_image(request, original, optimized):
+    """Serve optimized.<format> for the best format the client accepts, or the original."""
+    headers = {'Vary': 'Accept'}
+    format = accepted_format(request)
+    if format:
+        optimized = f'{optimized}.{format}'
+        if os.path.exists(optimized):
+            app.store.touch(optimized)
+            return file_response(request, optimized, IMMUTABLE, headers)
+    if os.path.exists(original):
+        app.store.touch(original)
+        if format and optimized not in flights:
+            await app.enqueue(optimize, original, optimized, format, key=optimized)
+        # Uploads get new file names, so a URL only changes when its optimized file is ready.
+        return file_response(request, original, TEMPORARY if format else IMMUTABLE, headers)
     else:
         return {'404': original.split('/')[-1]}
 
 
 @app.gethtml('/{width}x{height}/{img}')
 async def resized_image(request: Request, width: int, height: int, img: str):
-    if width > 6000 or height > 6000:
-        prop = 6000 / max(width, height)
-        width = int(width * prop)
-        height = int(height * prop)
-    original = abs_path() + '/original/' + img
-    resized = abs_path() + f'/original/thumb/{width}x{height}_{img}'
-    optimized = abs_path() + f'/optimized/thumb/{width}x{height}_{img}.avif'
+    size = fit(width, height, app.buckets)
+    if not size:
+        return {'404': img}
+    width, height = size
+    original, resized, optimized = thumb_paths(img, width, height)
     if not os.path.exists(resized):
-        proc = await asyncio.create_subprocess_shell(
-            f'convert {original} -gravity Center -extent {width}:{height} -resize {width}x{height} {resized}',
-            stdout=asyncio.subprocess.PIPE)
-        await proc.communicate()
-    return await serve_image(resized, optimized)
+        if not os.path.exists(original):
+            return {'404': img}
+        try:
+            await resize(original, resized, width, height)
+        except engine.Busy:
+            return file_response(request, original, TEMPORARY)
+        except engine.DecodeError:
+            return {'404': img}
+    return await serve_image(request, resized, optimized)
 
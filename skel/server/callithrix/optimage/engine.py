@@ -0,0 +1,180 @@
+"""Image engines.
+
+PillowEngine does the work in a bounded process pool. SubprocessEngine runs
+ImageMagick and ffmpeg, and is used when Pillow (with AVIF support) isn't
+installed: uv add pillow (and pillow-avif-plugin for Pillow < 11.2).
+"""
+import os
+import asyncio
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+
+
+class Busy(Exception):
+    """Too many images are waiting for the engine."""
+
+
+class DecodeError(Exception):
+    """The original isn't an image the engine can read."""
+
+
+def temp_path(target):
+    return f'{target}.{os.getpid()}.tmp'
+
+
+def pillow_image():
+    Image = importlib.import_module('PIL.Image')
+    try:
+        importlib.import_module('pillow_avif')
+    except ImportError:
+        pass
+    return Image
+
+
+def pillow_frames(image):
+    ImageSequence = importlib.import_module('PIL.ImageSequence')
+    return [frame.copy() for frame in ImageSequence.Iterator(image)]
+
+
+def pillow_save(frames, target, format, **options):
+    if len(frames) > 1:
+        options.update(save_all=True, append_images=frames[1:])
+    temp = temp_path(target)
+    frames[0].save(temp, format=format, **options)
+    os.replace(temp, target)
+
+
+def pillow_open(Image, original):
+    """Open original and copy its frames, raising DecodeError if it is corrupt or not an image."""
+    try:
+        with Image.open(original) as image:
+            return image.format, pillow_frames(image), image.info.get('duration')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise DecodeError(f'{original}: {e}') from None
+
+
+def pillow_resize(original, target, width, height):
+    """Crop the center to the width:height aspect ratio and resize to width x height."""
+    Image = pillow_image()
+    ImageOps = importlib.import_module('PIL.ImageOps')
+    format, frames, duration = pillow_open(Image, original)
+    frames = [ImageOps.fit(frame, (width, height), Image.LANCZOS) for frame in frames]
+    options = {'duration': duration, 'loop': 0} if len(frames) > 1 and duration else {}
+    pillow_save(frames, target, format, **options)
+
+
+def pillow_encode(original, target, format, quality):
+    Image = pillow_image()
+    _, frames, duration = pillow_open(Image, original)
+    frames = [frame.convert('RGBA' if 'A' in frame.getbands() or 'transparency' in frame.info else 'RGB')
+              for frame in frames]
+    options = {'duration': duration, 'loop': 0} if len(frames) > 1 and duration else {}
+    pillow_save(frames, target, format.upper(), quality=quality, **options)
+
+
+class Engine:
+    """Runs image operations with at most workers at a time and queue_size waiting."""
+
+    def __init__(self, workers=2, queue_size=100, quality=50):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.quality = quality
+        self.semaphore = asyncio.Semaphore(workers)
+        self.pending = 0
+
+    async def run(self, fn, *args):
+        if self.pending >= self.workers + self.queue_size:
+            raise Busy()
+        self.pending += 1
+        try:
+            async with self.semaphore:
+                return await self.execute(fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def resize(self, original, target, width, height):
+        return await self.run(self.resize_image, original, target, width, height)
+
+    async def encode(self, original, target, format='avif'):
+        return await self.run(self.encode_image, original, target, format, self.quality)
+
+    def close(self):
+        pass
+
+
+class PillowEngine(Engine):
+    resize_image = staticmethod(pillow_resize)
+    encode_image = staticmethod(pillow_encode)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = None
+
+    @staticmethod
+    def available():
+        try:
+            Image = pillow_image()
+        except ImportError:
+            return False
+        return 'AVIF' in Image.registered_extensions().values()
+
+    async def execute(self, fn, *args):
+        if not self.executor:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+class SubprocessEngine(Engine):
+
+    @staticmethod
+    def available():
+        return True
+
+    async def execute(self, fn, *args):
+        return await fn(*args)
+
+    async def resize_image(self, original, target, width, height):
+        await self.exec(target, target.rsplit('.', 1)[-1], 'convert', original, '-gravity', 'Center',
+                        '-extent', f'{width}:{height}', '-resize', f'{width}x{height}')
+
+    async def encode_image(self, original, target, format, quality):
+        if original.endswith('.gif') and format == 'avif':
+            await self.exec(target, format, 'ffmpeg', '-hide_banner', '-i', original, '-c:v', 'libsvtav1',
+                            '-crf', '30', '-preset', '4', '-pix_fmt', 'yuv420p10le', '-svtav1-params', 'tune=0',
+                            '-y')
+        else:
+            await self.exec(target, format, 'convert', original, '-quality', f'{quality}%')
+
+    async def exec(self, target, extension, *command):
+        """Run command with a temporary output file as the last argument, then move it in place.
+
+        Arguments are passed straight to the program, never through a shell.
+        """
+        temp = f'{temp_path(target)}.{extension}'
+        proc = await asyncio.create_subprocess_exec(*command, temp, stdout=asyncio.subprocess.DEVNULL)
+        await proc.wait()
+        if proc.returncode or not os.path.exists(temp):
+            if os.path.exists(temp):
+                os.remove(temp)
+            # The programs don't tell a corrupt original from other failures.
+            raise DecodeError(f'{command[0]} failed for {target} ({proc.returncode})')
+        os.replace(temp, target)
+
+
+engines = {
+    'pillow': PillowEngine,
+    'subprocess': SubprocessEngine,
+}
+
+
+def from_config(config):
+    """Build the engine from the "images" section of config.json."""
+    name = config.get('engine', 'auto')
+    if name == 'auto':
+        name = 'pillow' if PillowEngine.available() else 'subprocess'
+    return engines[name](**{key: config[key] for key in ('workers', 'queue_size', 'quality') if key in config})
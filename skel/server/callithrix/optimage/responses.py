@@ -0,0 +1,81 @@
+import os
+import asyncio
+from mimetypes import guess_type
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# For originals served while the optimized image isn't ready: the same URL will change soon.
+TEMPORARY = 'public, max-age=60'
+
+
+def not_modified(request, etag, mtime):
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        return any(tag.strip().removeprefix('W/') in (etag, '*') for tag in if_none_match.split(','))
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def byte_range(request, etag, size):
+    """(start, end) of a single Range request, None to send the whole file, or False if unsatisfiable."""
+    value = request.headers.get('range', '')
+    if not value.startswith('bytes=') or ',' in value:
+        return None
+    if_range = request.headers.get('if-range')
+    if if_range and if_range != etag:
+        return None
+    start, _, end = value.removeprefix('bytes=').strip().partition('-')
+    try:
+        if not start:
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+async def read_range(path, start, end, chunk_size=64 * 1024):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining:
+            chunk = await asyncio.to_thread(f.read, min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(request, path, cache_control=IMMUTABLE, headers={}):
+    """FileResponse with a strong ETag, conditional GET (304) and single Range support."""
+    stat = os.stat(path)
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    headers = {
+        **headers,
+        'ETag': etag,
+        'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+    }
+    if not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    selected = byte_range(request, etag, stat.st_size)
+    if selected is False:
+        return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{stat.st_size}'})
+    if selected:
+        start, end = selected
+        return StreamingResponse(read_range(path, start, end), status_code=206, headers={
+            **headers,
+            'Content-Range': f'bytes {start}-{end}/{stat.st_size}',
+            'Content-Length': str(end - start + 1),
+        }, media_type=guess_type(path)[0] or 'application/octet-stream')
+    return FileResponse(path, headers=headers, stat_result=stat)
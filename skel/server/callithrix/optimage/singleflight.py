@@ -0,0 +1,87 @@
+import os
+import time
+import uuid
+import asyncio
+
+
+class SingleFlight:
+    """Produces each file once, however many requests and processes ask for it.
+
+    Requests in the same process await the same task. Processes coordinate
+    through a lock file next to the target; a lock older than lock_timeout is
+    considered abandoned by a dead process and removed.
+    """
+
+    def __init__(self, lock_timeout=600, poll_interval=0.05, max_poll_interval=1):
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.flights = {}
+
+    def __contains__(self, target):
+        return target in self.flights
+
+    async def run(self, target, produce):
+        """Return target, calling the coroutine function produce() to create it if needed."""
+        task = self.flights.get(target)
+        if not task:
+            if os.path.exists(target):
+                return target
+            task = asyncio.create_task(self.produce(target, produce))
+            self.flights[target] = task
+            task.add_done_callback(lambda done: self.done(target, done))
+        # A waiter that goes away (client disconnected) doesn't cancel the work for the others.
+        return await asyncio.shield(task)
+
+    def done(self, target, task):
+        self.flights.pop(target, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def produce(self, target, produce):
+        lock = f'{target}.lock'
+        delay = self.poll_interval
+        while not self.acquire(lock):
+            if os.path.exists(target):
+                return target
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+        try:
+            if not os.path.exists(target):
+                await produce()
+            return target
+        finally:
+            try:
+                os.remove(lock)
+            except FileNotFoundError:
+                pass
+
+    def acquire(self, lock):
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(lock) > self.lock_timeout:
+                self.remove_stale(lock)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def remove_stale(self, lock):
+        """Remove an abandoned lock without removing a fresh one that replaced it.
+
+        The lock is renamed aside first, which is atomic, and only then checked again.
+        """
+        aside = f'{lock}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+        os.rename(lock, aside)
+        try:
+            if time.time() - os.path.getmtime(aside) <= self.lock_timeout:
+                # Another process took the lock in between: give it back, unless it was taken again.
+                try:
+                    os.link(aside, lock)
+                except FileExistsError:
+                    pass
+        finally:
+            os.remove(aside)
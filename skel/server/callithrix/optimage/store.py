@@ -0,0 +1,127 @@
+import os
+import math
+import time
+from collections import OrderedDict
+
+
+class DerivativeStore:
+    """Resized and optimized images, kept under a disk quota.
+
+    The index maps each file to its size, least recently used first. When the
+    total goes over quota, or the index over max_entries, the least recently
+    used files are deleted; they are generated again if requested. Every
+    server process writes to the same folders, so the index is rebuilt from
+    disk at most every rescan_interval seconds after new files are added,
+    ordered by the later of the file time and its last use in this process.
+    """
+
+    def __init__(self, folders, quota=1024 ** 3, max_entries=100000, rescan_interval=60):
+        self.folders = folders
+        self.quota = quota
+        self.max_entries = max_entries
+        self.rescan_interval = rescan_interval
+        self.entries = OrderedDict()
+        self.used = {}
+        self.total = 0
+        self.scanned = 0
+        self.scanning = False
+
+    def walk(self):
+        """(mtime, path, size) of the files on disk. Only reads the folders, so it can run in a thread."""
+        files = []
+        for folder in self.folders:
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_file() and not entry.name.endswith(('.lock', '.tmp')) and '.tmp.' not in entry.name:
+                            stat = entry.stat()
+                            files.append((stat.st_mtime, entry.path, stat.st_size))
+            except FileNotFoundError:
+                pass
+        return files
+
+    def load(self, files, started=0):
+        """Replace the index with files from walk(), which began at the time started.
+
+        Files added by this process while walking are kept, even if the walk missed them.
+        """
+        files = [(max(mtime, self.used.get(path, 0)), path, size) for mtime, path, size in files]
+        seen = {path for _, path, _ in files}
+        files.extend((self.used[path], path, size) for path, size in self.entries.items()
+                     if path not in seen and self.used.get(path, 0) >= started)
+        files.sort()
+        self.entries = OrderedDict((path, size) for _, path, size in files)
+        self.used = {path: self.used[path] for path in self.entries if path in self.used}
+        self.total = sum(self.entries.values())
+        self.scanned = time.monotonic()
+        self.enforce()
+
+    def scan(self):
+        self.load(self.walk())
+
+    def needs_scan(self):
+        """Other processes may have added files since the last scan."""
+        return not self.scanning and time.monotonic() - self.scanned > self.rescan_interval
+
+    def add(self, path):
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        self.discard(path)
+        self.entries[path] = size
+        self.used[path] = time.time()
+        self.total += size
+        self.enforce()
+
+    def touch(self, path):
+        if path in self.entries:
+            self.entries.move_to_end(path)
+            self.used[path] = time.time()
+
+    def discard(self, path):
+        self.used.pop(path, None)
+        self.total -= self.entries.pop(path, 0)
+
+    def enforce(self):
+        while self.entries and (self.total > self.quota or len(self.entries) > self.max_entries):
+            path, size = self.entries.popitem(last=False)
+            self.used.pop(path, None)
+            self.total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def parse_size(size):
+    width, height = size.split('x')
+    return int(width), int(height)
+
+
+def fit(width, height, buckets, max_size=6000):
+    """The size to generate for a width x height request, or None if it isn't valid.
+
+    Sizes are scaled down to max_size, then snapped to the buckets.
+    """
+    if width < 1 or height < 1:
+        return None
+    if width > max_size or height > max_size:
+        prop = max_size / max(width, height)
+        width = max(int(width * prop), 1)
+        height = max(int(height * prop), 1)
+    # Any size would do, so a crawler could fill the disk with thumbnails. Buckets limit them.
+    return snap(width, height, buckets)
+
+
+def snap(width, height, buckets):
+    """The bucket closest to width x height in aspect ratio, and then the smallest that covers it."""
+    if not buckets:
+        return width, height
+    ratio = math.log(width / height)
+    distance = min(abs(math.log(w / h) - ratio) for w, h in buckets)
+    candidates = sorted((w, h) for w, h in buckets if abs(abs(math.log(w / h) - ratio) - distance) < 1e-9)
+    for w, h in candidates:
+        if w >= width and h >= height:
+            return w, h
+    return candidates[-1]
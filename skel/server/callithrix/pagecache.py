@@ -0,0 +1,91 @@
+import time
+import asyncio
+import hashlib
+import traceback
+from collections import OrderedDict
+from fastapi.responses import Response
+
+
+class CachedPage:
+    def __init__(self, response, ttl, stale):
+        self.body = response.body
+        self.status_code = response.status_code
+        self.media_type = response.media_type
+        self.headers = {
+            name: value for name, value in response.headers.items()
+            if name not in ('content-length', 'set-cookie', 'etag', 'cache-control')
+        }
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()
+        self.fresh_until = time.monotonic() + ttl
+        self.stale_until = self.fresh_until + stale
+
+    def response(self, request):
+        headers = {**self.headers, 'etag': self.etag, 'cache-control': 'no-cache'}
+        if not_modified(request, self.etag):
+            return Response(status_code=304, headers={'etag': self.etag, 'cache-control': 'no-cache'})
+        return Response(self.body, status_code=self.status_code, headers=headers,
+                        media_type=self.media_type)
+
+
+def not_modified(request, etag):
+    tags = request.headers.get('if-none-match')
+    if not tags:
+        return False
+    return any(tag.strip().removeprefix('W/') in (etag, '*') for tag in tags.split(','))
+
+
+class PageCache:
+    """Rendered pages of anonymous visitors.
+
+    A page is served from memory for ttl seconds. For another stale seconds it
+    is still served, while a single background render replaces it.
+    """
+
+    def __init__(self, max_entries=500, stale=None):
+        self.max_entries = max_entries
+        self.stale = stale
+        self.entries = OrderedDict()
+        self.refreshing = {}
+
+    @staticmethod
+    def cacheable(request):
+        return (request.method == 'GET'
+                and not request.session.get('userid')
+                and not request.session.get('flash'))
+
+    def key(self, request, language):
+        query = tuple(sorted(request.query_params.multi_items()))
+        return request.url.path, query, language, bool(request.session.get('userid'))
+
+    async def fetch(self, key, request, render, ttl):
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry and now < entry.stale_until:
+            self.entries.move_to_end(key)
+            if now >= entry.fresh_until and key not in self.refreshing:
+                self.refreshing[key] = asyncio.create_task(self.refresh(key, render, ttl))
+            return entry.response(request)
+        response = await render()
+        entry = self.store(key, response, ttl)
+        return entry.response(request) if entry else response
+
+    async def refresh(self, key, render, ttl):
+        try:
+            self.store(key, await render(), ttl)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.refreshing.pop(key, None)
+
+    def store(self, key, response, ttl):
+        if response.status_code != 200 or not hasattr(response, 'body'):
+            return None
+        entry = CachedPage(response, ttl, ttl if self.stale is None else self.stale)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,184 @@
+"""Password hashers."""
+import os
+import base64
+import asyncio
+import hashlib
+import hmac
+import typing
+import importlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class ScryptHasher:
+    """Scrypt hasher. Hashes look like scrypt$n$r$p$salt$hash."""
+
+    algorithm = "scrypt"
+
+    def __init__(self, n: int = 2 ** 15, r: int = 8, p: int = 1, dklen: int = 32):
+        """Initialize."""
+        self.n = n
+        self.r = r
+        self.p = p
+        self.dklen = dklen
+
+    def identify(self, encoded: str) -> bool:
+        """Tell if the hash was made by this hasher."""
+        return encoded.startswith(f"{self.algorithm}$")
+
+    def derive(self, password: str, salt: bytes, n: int, r: int, p: int, dklen: int) -> bytes:
+        """Derive the key."""
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=dklen,
+                              maxmem=128 * n * r * p * 2)
+
+    def encode(self, password: str) -> str:
+        """Hash the password with a random salt."""
+        salt = os.urandom(16)
+        key = self.derive(password, salt, self.n, self.r, self.p, self.dklen)
+        return "$".join([self.algorithm, str(self.n), str(self.r), str(self.p),
+                         base64.b64encode(salt).decode(), base64.b64encode(key).decode()])
+
+    def verify(self, password: str, encoded: str) -> bool:
+        """Check the password against the hash."""
+        _, n, r, p, salt, key = encoded.split("$")
+        key = base64.b64decode(key)
+        derived = self.derive(password, base64.b64decode(salt), int(n), int(r), int(p), len(key))
+        return hmac.compare_digest(derived, key)
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """Tell if the hash was made with other parameters."""
+        _, n, r, p, _, _ = encoded.split("$")
+        return (int(n), int(r), int(p)) != (self.n, self.r, self.p)
+
+
+class Argon2Hasher:
+    """Argon2id hasher. Requires argon2-cffi (uv add argon2-cffi)."""
+
+    algorithm = "argon2"
+
+    def __init__(self, **params):
+        """Initialize."""
+        importlib.import_module("argon2")
+        self.params = params
+
+    def hasher(self):
+        """Return the argon2-cffi hasher."""
+        return importlib.import_module("argon2").PasswordHasher(**self.params)
+
+    def identify(self, encoded: str) -> bool:
+        """Tell if the hash was made by this hasher."""
+        return encoded.startswith("$argon2")
+
+    def encode(self, password: str) -> str:
+        """Hash the password."""
+        return self.hasher().hash(password)
+
+    def verify(self, password: str, encoded: str) -> bool:
+        """Check the password against the hash."""
+        try:
+            return self.hasher().verify(encoded, password)
+        except importlib.import_module("argon2").exceptions.VerificationError:
+            return False
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """Tell if the hash was made with other parameters."""
+        return self.hasher().check_needs_rehash(encoded)
+
+
+class LegacySHA256Hasher:
+    """Single round SHA-256 salted with the secret key and the user id.
+
+    Only used to verify hashes created by older versions, which are then rehashed.
+    """
+
+    algorithm = "sha256"
+
+    def __init__(self, secret_key: str):
+        """Initialize."""
+        self.secret_key = secret_key
+
+    def identify(self, encoded: str) -> bool:
+        """Tell if the hash was made by this hasher."""
+        return "$" not in encoded
+
+    def encode(self, password: str, user_id: int) -> str:
+        """Hash the password."""
+        return hashlib.sha256(f"{password}{self.secret_key}{user_id}".encode()).hexdigest()
+
+    def verify(self, password: str, encoded: str, user_id: int) -> bool:
+        """Check the password against the hash."""
+        return hmac.compare_digest(self.encode(password, user_id), encoded)
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """Legacy hashes always need rehash."""
+        return True
+
+
+hashers = {
+    "scrypt": ScryptHasher,
+    "argon2": Argon2Hasher,
+}
+
+
+class PasswordHasher:
+    """Runs hashers in a bounded pool, so the event loop is never blocked by a KDF."""
+
+    def __init__(self, hasher: object, legacy: list = (), workers: int = 2,
+                 processes: bool = False):
+        """Initialize.
+
+        hasher is used for new hashes. Legacy hashers are only used for verification.
+        """
+        self.hasher = hasher
+        self.legacy = list(legacy)
+        self.workers = workers
+        self.processes = processes
+        self.executor = None
+        self.semaphore = asyncio.Semaphore(workers)
+
+    @classmethod
+    def from_config(cls, config: dict, secret_key: str) -> "PasswordHasher":
+        """Build the hasher from the "password_hasher" section of config.json."""
+        config = dict(config)
+        algorithm = config.pop("algorithm", "scrypt")
+        workers = config.pop("workers", 2)
+        processes = config.pop("processes", False)
+        hasher = hashers[algorithm](**config)
+        legacy = [ScryptHasher()] if algorithm != "scrypt" else []
+        legacy.append(LegacySHA256Hasher(secret_key))
+        return cls(hasher, legacy, workers=workers, processes=processes)
+
+    async def run(self, fn: typing.Callable, *args):
+        """Run fn in the pool, waiting for a free worker."""
+        if not self.executor:
+            pool = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+            self.executor = pool(max_workers=self.workers)
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def identify(self, encoded: str) -> object | None:
+        """Return the hasher that made the hash."""
+        for hasher in [self.hasher] + self.legacy:
+            if hasher.identify(encoded):
+                return hasher
+        return None
+
+    async def encode(self, password: str) -> str:
+        """Hash the password."""
+        return await self.run(self.hasher.encode, password)
+
+    async def verify(self, password: str, encoded: str, user_id: int = None) -> tuple[bool, bool]:
+        """Check the password. Return (valid, needs_rehash)."""
+        hasher = self.identify(encoded or "")
+        if not hasher or not password:
+            return False, False
+        if isinstance(hasher, LegacySHA256Hasher):
+            valid = await self.run(hasher.verify, password, encoded, user_id)
+        else:
+            valid = await self.run(hasher.verify, password, encoded)
+        return valid, valid and (hasher is not self.hasher or hasher.needs_rehash(encoded))
+
+    def close(self) -> None:
+        """Shut the pool down."""
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -1,16 +1,32 @@
 """Base repository."""
 from datetime import datetime
+from functools import partial
 from pydantic import BaseModel, SecretStr
 import typing
-import hashlib
+from .hashers import PasswordHasher
 
 class Repository:
     """Base repository."""
 
-    def __init__(self, storage, secret_key: str = None):
+    def __init__(self, storage, secret_key: str = None, hasher: PasswordHasher = None):
         """Initialize repository."""
         self.storage = storage
         self.secret_key = secret_key
+        self.hasher = hasher or PasswordHasher.from_config({}, secret_key)
+        self.listeners = []
+
+    def on_change(self, callback: typing.Callable) -> typing.Callable:
+        """Register a callback(entity, entity_id) called after every committed write."""
+        self.listeners.append(callback)
+        return callback
+
+    def changed(self, entity: str, entity_id: int | None, connection: typing.Any = None) -> None:
+        """Notify listeners that a row was written, after its transaction commits."""
+        self.storage.after_commit(connection, partial(self.notify, entity.lower(), entity_id))
+
+    def notify(self, entity: str, entity_id: int | None) -> None:
+        for callback in self.listeners:
+            callback(entity, entity_id)
 
     async def get(self, entity: str, entity_id: int, connection: typing.Any = None,
                   serialize: bool = True) -> dict | None:
@@ -30,6 +46,26 @@ class Repository:
             result = list(map(dict, result))
         return result
 
+    async def stream(self, entity: str, f: dict = {}, fields: list = [], batch_size: int = 500,
+                     connection: typing.Any = None,
+                     serialize: bool = True) -> typing.AsyncIterator[dict]:
+        """Iterate over all matching rows, fetching them in batches ordered by id."""
+        if fields and 'id' not in fields:
+            fields = ['id', *fields]
+        last_id = None
+        while True:
+            filters = dict(f)
+            if last_id is not None:
+                filters['&id'] = ('>', last_id)
+            rows = await self.find(entity, filters, fields=fields, limit=batch_size,
+                                   order_by={'id': 'ASC'}, connection=connection,
+                                   serialize=serialize)
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1]['id']
+
     async def find_one(self, entity: str, f: dict = {}, fields: list = [],
                        offset: int | None = None, connection: typing.Any = None,
                        order_by: dict = {"id": "ASC"}, serialize: bool = True) -> list[dict]:
@@ -41,44 +77,46 @@ class Repository:
             return list(map(dict, response))[0] if serialize else response[0]
         return None
 
-    def encode_password(self, password: str, id: int) -> str:
-        """Encode password."""
-        return hashlib.sha256(f"{password}{self.secret_key}{id}".encode()).hexdigest()
+    async def encode_password(self, password: str) -> str:
+        """Hash password in the hasher pool."""
+        return await self.hasher.encode(password)
+
+    async def verify_password(self, password: str, row: dict, entity: str = 'user',
+                              field: str = 'password', connection: typing.Any = None) -> bool:
+        """Check password against the row hash, rehashing it if made by an older hasher."""
+        valid, needs_rehash = await self.hasher.verify(password, row.get(field), row.get('id'))
+        if needs_rehash:
+            row[field] = await self.encode_password(password)
+            await self._update(entity, row['id'], {field: row[field]}, connection=connection)
+        return valid
 
-    def dict_from_entity(self, entity: BaseModel) -> dict:
+    async def dict_from_entity(self, entity: BaseModel) -> dict:
         data = entity.dict()
-        has_password = False
         for k, v in data.items():
             if isinstance(v, SecretStr):
-                data[k] = self.encode_password(v.get_secret_value(), data.get('id'))
-                has_password = True
-        return data, has_password
+                data[k] = await self.encode_password(v.get_secret_value())
+        return data
 
     async def save(self, entity: str, data: dict | BaseModel, connection: typing.Any = None) -> dict:
         """Save model."""
-        has_password = False
         if not isinstance(data, dict):
-            original = data
-            data, has_password = self.dict_from_entity(data)
+            data = await self.dict_from_entity(data)
         if data.get('id'):
             return await self.update(entity, data['id'], data, connection=connection)
         data["created_at"] = datetime.now()
         data["updated_at"] = datetime.now()
-        saved = await self._save(entity, data, connection=connection)
-        if has_password:
-            original.id = saved['id']
-            data, _ = self.dict_from_entity(original)
-            await self._update(entity, data['id'], data, connection=connection)
-        return saved
+        return await self._save(entity, data, connection=connection)
 
     async def _save(self, entity: str, data: dict, connection: typing.Any = None) -> dict:
         """Save model. Do not update created_at or updated_at."""
-        return await self.storage.save(entity, data, connection=connection)
+        saved = await self.storage.save(entity, data, connection=connection)
+        self.changed(entity, saved and saved['id'], connection)
+        return saved
 
     async def update(self, entity: str, entity_id: int, data: dict | BaseModel,
                      connection: typing.Any = None) -> None:
         if not isinstance(data, dict):
-            data, _ = self.dict_from_entity(data)
+            data = await self.dict_from_entity(data)
         """Update model."""
         data["updated_at"] = datetime.now()
         await self._update(entity, entity_id, data, connection=connection)
@@ -87,11 +125,15 @@ class Repository:
     async def _update(self, entity: str, entity_id: int, data: dict,
                       connection: typing.Any = None) -> None:
         """Update model. Do not update updated_at."""
-        return await self.storage.update(entity, entity_id, data, connection=connection)
+        result = await self.storage.update(entity, entity_id, data, connection=connection)
+        self.changed(entity, entity_id, connection)
+        return result
 
     async def delete(self, entity: int, entity_id: int, connection: typing.Any = None) -> None:
         """Delete model."""
-        return await self.storage.delete(entity, entity_id, connection=connection)
+        result = await self.storage.delete(entity, entity_id, connection=connection)
+        self.changed(entity, entity_id, connection)
+        return result
 
     async def get_tables(self) -> list[str]:
         """Get tables."""
@@ -25,6 +25,13 @@ def migrate(models, db_url: str,
             entity.schema()["properties"],
             audit_table=get_audit_table(entity)
         ))
+        create_tables_executed_sql.extend(create_indexes(
+            db,
+            entity.__name__.lower(),
+            entity.schema()["properties"],
+            label_field=get_label_field(entity)
+        ))
+    db.commit()
     db._adapter.close_connection()
     return create_tables_executed_sql
 
@@ -35,6 +42,40 @@ def get_audit_table(entity):
     return ""
 
 
+def get_label_field(entity) -> str | None:
+    """Get the column used to search and display rows of the entity."""
+    label = getattr(entity, "label_field", None)
+    if label:
+        return label
+    if "name" in entity.model_fields:
+        return "name"
+    return None
+
+
+def create_indexes(db: DAL, entity: str, schema: dict, label_field: str | None = None) -> list[str]:
+    """Create indexes for the label column and columns declared with index=True.
+
+    The label also gets an index on lower(label), for case insensitive prefix searches.
+    """
+    columns = [col for col, v in schema.items() if v.get("index") and col != "id"]
+    if label_field and label_field in schema and label_field not in columns:
+        columns.append(label_field)
+    statements = [f"CREATE INDEX IF NOT EXISTS {entity}_{col}_idx ON {entity} ({col});" for col in columns]
+    if label_field and label_field in schema:
+        statements.append(f"CREATE INDEX IF NOT EXISTS {entity}_{label_field}_lower_idx "
+                          f"ON {entity} ((lower({label_field})));")
+    executed_sql = []
+    for sql in statements:
+        try:
+            db.executesql(sql)
+        except Exception:
+            # Engines without IF NOT EXISTS for indexes (MySQL) fail when it already exists.
+            db.rollback()
+            continue
+        executed_sql.append(sql)
+    return executed_sql
+
+
 def create_table(db: DAL, entity: str, schema: dict, audit_table: str = ""):
     """Create table."""
     audit_columns = audit_table and [
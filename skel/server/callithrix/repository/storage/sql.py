@@ -2,6 +2,7 @@
 import urllib.parse
 # from .sql_backends import postgresql_asyncpg, sqlite_aiosqlite, mysql_asyncmy
 from . import migrations
+from .sql_backends import query_builder
 import typing
 import contextlib
 import importlib
@@ -24,6 +25,8 @@ class Storage:
             "mysql": ".sql_backends.mysql_asyncmy",
         }
         self.backend: typing.Any = None
+        # id(connection) -> callbacks to run when its transaction commits.
+        self.pending = {}
 
     async def init(self, **kwargs) -> None:
         """Initialize."""
@@ -53,6 +56,7 @@ class Storage:
     async def transaction(self):
         """Transaction."""
         conn = await self.backend.start_transaction()
+        callbacks = self.pending[id(conn)] = []
         try:
             yield conn
         except Exception:
@@ -61,7 +65,18 @@ class Storage:
         else:
             await self.backend.commit(conn)
         finally:
+            self.pending.pop(id(conn), None)
             await self.backend.end_transaction(conn)
+        for callback in callbacks:
+            callback()
+
+    def after_commit(self, connection: typing.Any, callback: typing.Callable) -> None:
+        """Call callback() once the transaction of connection commits, or now if there is none."""
+        callbacks = self.pending.get(id(connection)) if connection is not None else None
+        if callbacks is None:
+            callback()
+        else:
+            callbacks.append(callback)
 
     async def save(self, entity: str, data: dict, connection: typing.Any = None) -> dict:
         """Save data."""
@@ -96,6 +111,10 @@ class Storage:
         """Execute sql."""
         return await self.backend.execute(sql, values, connection=connection)
 
+    def placeholder(self, count: int) -> str:
+        """Return the engine's placeholder for the count-th (1-based) parameter of a raw query."""
+        return query_builder.placeholder(self.backend.param_style, count)
+
     async def create_sqlite_in_memory_tables(self, create_table_sql: list[str]) -> None:
         """Create tables in memory."""
         await self.backend.create_sqlite_in_memory_tables(create_table_sql)
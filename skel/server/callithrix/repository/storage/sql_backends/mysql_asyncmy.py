@@ -7,6 +7,8 @@ import typing
 class SQLBackend:
     """SQL backend."""
 
+    param_style = "%s"
+
     def __init__(self, connection_string: str, connection_params: dict):
         """Initialize."""
         self.connection_string = connection_string
@@ -138,14 +140,14 @@ class SQLBackend:
 
         async with self.pool.acquire() as conn:
             async with conn.cursor(cursor=DictCursor) as cur:
-                await cur.execute(query, *values)
+                await cur.execute(query, tuple(values) or None)
                 await conn.commit()
                 return await cur.fetchall()
 
     async def __execute_transaction(self, query: str, values: tuple,
                                     connection: typing.Any) -> None:
         """Execute transaction."""
-        await connection["cursor"].execute(query, *values)
+        await connection["cursor"].execute(query, tuple(values) or None)
         return await connection["cursor"].fetchall()
 
     async def truncate_db(self) -> None:
@@ -39,9 +39,14 @@ def select_query_builder(table_name: str, data: dict = {}, fields: list = [],
             value = ("=", value)
 
         and_or = __and_or(key)
-        op, value_count = __get_operation(value, value_count, param_style)
         if and_or["token"] and not first_clause:
             query.append(and_or['token'])
+        if value[0].lower() == "istartswith":
+            clause, value, value_count = __istartswith(and_or["key"], value[1], value_count, param_style)
+            query.append(clause)
+            values.extend(value)
+            continue
+        op, value_count = __get_operation(value, value_count, param_style)
         query.append(and_or['key'])
         query.append(op)
         _value = value[1]
@@ -103,12 +108,32 @@ def __handle_in_not_in(op: str, value: tuple, value_count: int, param_style: str
     op = op[:-2] + ")"
     return op, value_count
 
+def __istartswith(key: str, prefix: str, value_count: int, param_style: str) -> tuple:
+    """Case insensitive prefix match that can use an index on lower(key).
+
+    The range is what the index serves; LIKE makes the match exact. "!" escapes
+    the LIKE wildcards because backslash escaping differs between engines.
+    """
+    column = f"lower({key})"
+    p = [__determine_placeholder(param_style, value_count + i) for i in range(3)]
+    clause = (f"({column} >= lower({p[0]}) AND {column} < lower({p[1]})"
+              f" AND {column} LIKE lower({p[2]}) ESCAPE '!')")
+    return clause, (prefix, prefix + "\uffff", escape_like(prefix) + "%"), value_count + 2
+
+def escape_like(text: str) -> str:
+    """Escape the LIKE wildcards in text, so it matches literally with ESCAPE '!'."""
+    return text.replace("!", "!!").replace("%", "!%").replace("_", "!_")
+
 def __determine_placeholder(param_style: str, count: int) -> str:
     """Determine placeholder."""
     if param_style == '$%d':
         return param_style % count
     return param_style
 
+def placeholder(param_style: str, count: int) -> str:
+    """Return the placeholder for the count-th (1-based) parameter of a raw query."""
+    return __determine_placeholder(param_style, count)
+
 def __handle_limit_offset(limit: int | None, offset: int | None) -> list:
     """Build limit and offset."""
     query = []
@@ -6,6 +6,8 @@ import typing
 class SQLBackend:
     """SQL backend."""
 
+    param_style = "?"
+
     def __init__(self, connection_string: str, connection_params: dict):
         """Initialize."""
         self.connection_string = f'migrations/{connection_string.split("//")[1]}'
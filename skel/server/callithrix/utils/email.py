@@ -1,4 +1,4 @@
-from smtplib import SMTP
+from smtplib import SMTP, SMTP_SSL, SMTPServerDisconnected
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
@@ -14,36 +14,86 @@ def init(config):
     password = config['smtp']['password']
 
 
-def enviar_email(subject, to, message, reply_to=sender):
+def build_message(subject, to, message, sender, reply_to=None):
     mimetext="html" if message.startswith('<') else "plain"
     if subject == '':
         raise Exception("Tipo de email indefinido!")
     if to == '':
         raise Exception("Endereço de email de destino inválido!")
 
+    email_msg = MIMEMultipart()
+    email_msg['From'] = sender
+    email_msg['To'] = to
+    email_msg['Subject'] = subject
+    email_msg['Reply-To'] = reply_to or sender
+
+    email_msg.attach(MIMEText(message, mimetext))
+    return email_msg
+
+
+def print_failure(subject, to, message):
+    print('## Erro ao enviar email ##')
+    print(f'* Assunto: {subject}')
+    print(f'* Para: {to}')
+    print(f'* Mensagem:\n{message}')
+
+
+def enviar_email(subject, to, message, reply_to=sender):
+    email_msg = build_message(subject, to, message, sender, reply_to)
+
     server = None
 
     try:
         server = SMTP(host, port)
-        email_msg = MIMEMultipart()
-        email_msg['From '] = sender
-        email_msg['Subject '] = subject
-        email_msg['Reply-To '] = reply_to
-
-        email_msg.attach(MIMEText(message, mimetext))
-
         server.ehlo()
         server.starttls()
         server.login(user, password)
         server.sendmail(sender, to, email_msg.as_string())
     except Exception:
-        print('## Erro ao enviar email ##')
-        print(f'* Assunto: {subject}')
-        print(f'* Para: {to}')
-        print(f'* Mensagem:\n{message}')
+        print_failure(subject, to, message)
         return False
     finally:
         if server:
             server.quit()
 
     return True
+
+
+class Connection:
+    """A reusable SMTP session. Blocking: use it from a worker thread."""
+
+    def __init__(self, config):
+        self.config = config
+        self.server = None
+
+    def open(self):
+        if self.server:
+            try:
+                self.server.noop()
+                return self.server
+            except SMTPServerDisconnected:
+                self.server = None
+        smtp = SMTP_SSL if self.config.get('ssl') else SMTP
+        server = smtp(self.config['host'], self.config['port'], timeout=self.config.get('timeout', 30))
+        server.ehlo()
+        if not self.config.get('ssl'):
+            server.starttls()
+        server.login(self.config['user'], self.config['password'])
+        self.server = server
+        return server
+
+    def send(self, subject, to, message, reply_to=None):
+        email_msg = build_message(subject, to, message, self.config['sender'], reply_to)
+        try:
+            self.open().sendmail(self.config['sender'], to, email_msg.as_string())
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.server:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None